@@ -9,20 +9,26 @@ Telegram Support Bot v2.0 - Production Ready
 """
 
 import asyncio
+import functools
 import logging
+import logging.handlers
 import sqlite3
 import os
+import queue
 import sys
-import traceback
-from datetime import datetime, timedelta
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future
+from datetime import datetime
 from pathlib import Path
-from typing import Optional, List, Dict, Any
-import html
+from typing import Optional, List, Dict, Any, Callable
 import json
 
 from telegram import Update, Bot, Message, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-from telegram.constants import ParseMode, ChatAction
+from telegram.ext import Application, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.constants import ParseMode, ChatAction, ChatType, MessageEntityType
 from telegram.error import TelegramError, NetworkError, TimedOut, BadRequest
 
 # ============================================================
@@ -31,14 +37,42 @@ from telegram.error import TelegramError, NetworkError, TimedOut, BadRequest
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "8443190094:AAEzVvqKbavZKHmEjsGu2WObrfB43qNfas0")
 SUPPORT_GROUP_ID = int(os.environ.get("SUPPORT_GROUP_ID", "-1003870321136"))
-ADMIN_IDS = [int(x.strip()) for x in os.environ.get("ADMIN_IDS", "2089427192,6696982829").split(",") if x.strip()]
+ADMIN_IDS = frozenset(int(x.strip()) for x in os.environ.get("ADMIN_IDS", "2089427192,6696982829").split(",") if x.strip())
+
+# Webhook mode when WEBHOOK_URL is set (public https base URL), long polling otherwise
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or None
+PORT = int(os.environ.get("PORT", "8443"))
+POLL_TIMEOUT_SECONDS = 50
+# Bot API requests share HTTP/2 connections; the pool only caps the number of connections
+API_HTTP_VERSION = "2"
+API_POOL_SIZE = 64
+
+# WARNING by default (PTB/httpx log every API request at INFO); LOG_LEVEL=INFO for details
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "WARNING").upper()
+
+# Topic deep links: t.me/c/<group id without -100>/<topic id>
+GROUP_LINK_PREFIX = f"https://t.me/c/{str(SUPPORT_GROUP_ID)[4:]}/"
 
 # Timing
 FOLLOWUP_HOURS_NORMAL = 24
 FOLLOWUP_HOURS_VIP = 12
 FOLLOWUP_MORNING_HOUR = 9
 ARCHIVE_AFTER_DAYS = 14
+ARCHIVE_INTERVAL_SECONDS = 3600
+ARCHIVE_CONCURRENCY = 5
+UNDO_CONCURRENCY = 5
+MAPPING_SLOTS = 100  # ring buffer size of sent_messages per user, the most /undo can reach
 OUTBOX_INTERVAL_SECONDS = 30
+OUTBOX_PER_SECOND = 25
+BROADCAST_PER_SECOND = 25  # stays below Telegram's 30 msg/s bot limit
+OPTIMIZE_INTERVAL_SECONDS = 900
+TOPIC_UPDATE_DELAY_SECONDS = 0.5
+CHAT_CACHE_TTL_SECONDS = 5
+CHAT_LIST_CACHE_SECONDS = 2
+TOPIC_CACHE_FLUSH_SECONDS = 60
+WAL_CHECKPOINT_SECONDS = 300
+COMPRESS_MIN_BYTES = 200  # notes longer than this are stored zlib-compressed
 
 # Messages
 WELCOME_MESSAGE = os.environ.get("WELCOME_MESSAGE", """Hey! 👋
@@ -47,6 +81,9 @@ Schreib mir einfach deine Frage – ich melde mich so schnell wie möglich.
 
 Sprachnachrichten, Bilder, alles kein Problem.""")
 
+# Telegram's HTML mode only needs &, < and > escaped in text (no attribute quoting)
+HTML_ESCAPE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
 STATUS = {"unread": "🔴", "read": "⚪", "answered": "🟢", "closed": "⚫", "followup": "💛"}
 PRIORITY = {"normal": "", "vip": "⭐", "urgent": "🚨"}
 
@@ -67,15 +104,154 @@ if not DATA_DIR.exists():
     DATA_DIR = Path(__file__).parent
 DB_PATH = DATA_DIR / "support.db"
 
+FTS_ENABLED = False  # set by init_db() when SQLite has FTS5
+
+# One long-lived connection per thread (handlers run on the event loop thread,
+# background jobs on the DB writer thread)
+_DB_LOCAL = threading.local()
+
 def get_db():
-    """Get database connection with WAL mode and busy timeout"""
-    conn = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES, timeout=10)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA busy_timeout=5000")
-    conn.execute("PRAGMA synchronous=NORMAL")
+    """Get the cached database connection (opened once with WAL mode and busy timeout).
+
+    Timestamps are stored as INTEGER unix epochs, so no type detection is needed.
+    """
+    conn = getattr(_DB_LOCAL, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False, cached_statements=256)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA cache_size=-20000")  # ~20 MB page cache per connection
+        conn.execute("PRAGMA mmap_size=268435456")  # read pages straight from the mapped file
+        conn.execute("PRAGMA temp_store=MEMORY")  # ORDER BY temp b-trees stay in RAM
+        conn.execute("PRAGMA cache_spill=OFF")  # dirty pages stay in the cache until commit
+        # Checkpoints only run from the DB writer thread, never inside a handler commit
+        conn.execute("PRAGMA wal_autocheckpoint=0")
+        _DB_LOCAL.conn = conn
     return conn
 
+def dict_row(cursor: sqlite3.Cursor, row: tuple) -> Dict:
+    return {col[0]: value for col, value in zip(cursor.description, row)}
+
+def dict_cursor() -> sqlite3.Cursor:
+    """Cursor returning dicts; plain cursors return tuples"""
+    c = get_db().cursor()
+    c.row_factory = dict_row
+    return c
+
+def pack_text(text: str):
+    """Long texts become a zlib BLOB, short ones stay TEXT (the column type tells them apart)"""
+    data = text.encode('utf-8')
+    return zlib.compress(data, 6) if len(data) > COMPRESS_MIN_BYTES else text
+
+def unpack_text(value) -> str:
+    return zlib.decompress(value).decode('utf-8') if isinstance(value, bytes) else value
+
+def close_db():
+    """Close the cached connection of the current thread"""
+    conn = getattr(_DB_LOCAL, "conn", None)
+    if conn is not None:
+        conn.close()
+        _DB_LOCAL.conn = None
+
+# ============================================================
+# DB WRITER THREAD (background jobs off the event loop)
+# ============================================================
+
+DB_WRITER_QUEUE = queue.Queue()
+DB_WRITER_THREAD: Optional[threading.Thread] = None
+
+def checkpoint_wal():
+    """Checkpoint and truncate the WAL; if a reader blocks that, copy back what is possible"""
+    try:
+        conn = get_db()
+        busy, log, done = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        if busy:
+            busy, log, done = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            if done < log:
+                logging.warning(f"WAL checkpoint incomplete: {done}/{log} pages, readers still busy")
+    except Exception as e:
+        logging.warning(f"WAL checkpoint failed: {e}")
+
+def db_writer_loop():
+    """Run queued (fn, args, future) jobs on this thread's own connection"""
+    next_checkpoint = time.monotonic() + WAL_CHECKPOINT_SECONDS
+    while True:
+        try:
+            job = DB_WRITER_QUEUE.get(timeout=max(0, next_checkpoint - time.monotonic()))
+        except queue.Empty:
+            job = ()
+        if job is None:
+            break
+        if job:
+            fn, args, fut = job
+            if fut.set_running_or_notify_cancel():
+                try:
+                    fut.set_result(fn(*args))
+                except Exception as e:
+                    fut.set_exception(e)
+        if time.monotonic() >= next_checkpoint:
+            checkpoint_wal()
+            next_checkpoint = time.monotonic() + WAL_CHECKPOINT_SECONDS
+    checkpoint_wal()
+    close_db()
+
+def submit_db(fn: Callable, *args) -> Future:
+    """Queue fn(*args) for the DB writer thread"""
+    fut = Future()
+    DB_WRITER_QUEUE.put((fn, args, fut))
+    return fut
+
+async def run_db(fn: Callable, *args):
+    """Run fn(*args) on the DB writer thread and await its result"""
+    return await asyncio.wrap_future(submit_db(fn, *args))
+
+def write_one(sql: str, params: tuple) -> int:
+    """Execute one write in its own transaction, return the affected row count"""
+    conn = get_db()
+    with conn:
+        return conn.execute(sql, params).rowcount
+
+def write_rows(sql: str, params: tuple) -> List[tuple]:
+    """Execute one write ... RETURNING in its own transaction, return all rows"""
+    conn = get_db()
+    with conn:
+        return conn.execute(sql, params).fetchall()
+
+def write_returning(sql: str, params: tuple) -> Optional[Dict]:
+    """Execute one write ... RETURNING * in its own transaction, return the row as a dict"""
+    conn = get_db()
+    with conn:
+        return dict_cursor().execute(sql, params).fetchone()
+
+def write_many(sql: str, rows: List[tuple]):
+    """Execute one statement for many rows under a single write lock"""
+    conn = get_db()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(sql, rows)
+
+def start_db_writer():
+    global DB_WRITER_THREAD
+    if DB_WRITER_THREAD is not None and DB_WRITER_THREAD.is_alive():
+        return
+    DB_WRITER_THREAD = threading.Thread(target=db_writer_loop, name="db-writer", daemon=True)
+    DB_WRITER_THREAD.start()
+
+def stop_db_writer():
+    """Finish queued jobs, checkpoint and stop the writer thread"""
+    global DB_WRITER_THREAD
+    if DB_WRITER_THREAD is None:
+        return
+    DB_WRITER_QUEUE.put(None)
+    DB_WRITER_THREAD.join()
+    DB_WRITER_THREAD = None
+
+def table_columns(c, table: str) -> set:
+    """Column names of a table (empty if it does not exist)"""
+    c.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in c.fetchall()}
+
 def init_db():
     """Initialize all database tables"""
     conn = get_db()
@@ -94,15 +270,18 @@ def init_db():
             unread_count INTEGER DEFAULT 0,
             last_message_preview TEXT,
             last_message_type TEXT,
-            last_message_at TIMESTAMP,
-            last_reply_at TIMESTAMP,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_message_at INTEGER,
+            last_reply_at INTEGER,
+            created_at INTEGER DEFAULT (strftime('%s', 'now')),
             is_archived INTEGER DEFAULT 0,
-            snoozed_until TIMESTAMP,
+            snoozed_until INTEGER,
             followup_stage INTEGER DEFAULT 0,
-            followup_done INTEGER DEFAULT 0
+            followup_done INTEGER DEFAULT 0,
+            msg_seq INTEGER DEFAULT 0
         )
     """)
+    if 'msg_seq' not in table_columns(c, 'chats'):
+        c.execute("ALTER TABLE chats ADD COLUMN msg_seq INTEGER DEFAULT 0")
     
     # Messages log
     c.execute("""
@@ -114,7 +293,7 @@ def init_db():
             content TEXT,
             file_id TEXT,
             telegram_msg_id INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at INTEGER DEFAULT (strftime('%s', 'now'))
         )
     """)
     
@@ -128,23 +307,41 @@ def init_db():
             message_id INTEGER,
             topic_id INTEGER,
             retry_count INTEGER DEFAULT 0,
-            next_retry_at TIMESTAMP,
+            next_retry_at INTEGER,
             status TEXT DEFAULT 'pending',
             error TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at INTEGER DEFAULT (strftime('%s', 'now'))
         )
     """)
     
-    # Message mapping for deletion
+    # Message mapping for deletion (ring buffer: 100 slots per user, slot = seq % 100)
+    old_mapping = table_columns(c, 'sent_messages')
+    if old_mapping and 'slot' not in old_mapping:
+        c.execute("ALTER TABLE sent_messages RENAME TO sent_messages_old")
     c.execute("""
         CREATE TABLE IF NOT EXISTS sent_messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
+            slot INTEGER,
+            seq INTEGER,
             topic_msg_id INTEGER,
             user_msg_id INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at INTEGER DEFAULT (strftime('%s', 'now')),
+            PRIMARY KEY (user_id, slot)
         )
     """)
+    if old_mapping and 'slot' not in old_mapping:
+        c.execute("""
+            INSERT OR REPLACE INTO sent_messages (user_id, slot, seq, topic_msg_id, user_msg_id, created_at)
+            SELECT user_id, seq % 100, seq, topic_msg_id, user_msg_id, created_at FROM (
+                SELECT *, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY id) AS seq
+                FROM sent_messages_old
+            )
+        """)
+        c.execute("""
+            UPDATE chats SET msg_seq=COALESCE(
+                (SELECT MAX(seq) FROM sent_messages WHERE sent_messages.user_id=chats.user_id), 0)
+        """)
+        c.execute("DROP TABLE sent_messages_old")
     
     # Sequences (multi-message templates)
     c.execute("""
@@ -157,7 +354,7 @@ def init_db():
             file_id TEXT,
             original_chat_id INTEGER,
             original_msg_id INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at INTEGER DEFAULT (strftime('%s', 'now'))
         )
     """)
     
@@ -167,7 +364,7 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
             note TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at INTEGER DEFAULT (strftime('%s', 'now'))
         )
     """)
     
@@ -176,208 +373,539 @@ def init_db():
         CREATE TABLE IF NOT EXISTS topic_cache (
             topic_id INTEGER PRIMARY KEY,
             topic_name TEXT,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            updated_at INTEGER DEFAULT (strftime('%s', 'now'))
         )
     """)
     
+    # Convert pre-epoch text timestamps. Values written by Python were local time,
+    # column defaults (CURRENT_TIMESTAMP) were UTC. Runs once: the scans are unindexed,
+    # so user_version records that the conversion is done.
+    if c.execute("PRAGMA user_version").fetchone()[0] < 1:
+        for table, column, local in [
+            ('chats', 'last_message_at', True), ('chats', 'last_reply_at', True),
+            ('chats', 'snoozed_until', True), ('chats', 'created_at', False),
+            ('outbox', 'next_retry_at', True), ('outbox', 'created_at', False),
+            ('messages', 'created_at', False), ('sent_messages', 'created_at', False),
+            ('sequences', 'created_at', False), ('notes', 'created_at', False),
+            ('topic_cache', 'updated_at', True),
+        ]:
+            modifier = ", 'utc'" if local else ""
+            c.execute(f"""
+                UPDATE {table} SET {column}=CAST(strftime('%s', {column}{modifier}) AS INTEGER)
+                WHERE typeof({column})='text'
+            """)
+        c.execute("PRAGMA user_version=1")
+    
     # Create indexes
-    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status ON outbox(status, next_retry_at)")
-    c.execute("CREATE INDEX IF NOT EXISTS idx_chats_status ON chats(status, is_archived)")
+    # Partial indexes cover exactly the rows the hot queries filter for
+    c.execute("DROP INDEX IF EXISTS idx_outbox_status")
+    c.execute("DROP INDEX IF EXISTS idx_chats_status")
+    c.execute("DROP INDEX IF EXISTS idx_chats_followup")
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_chats_unread ON chats(priority, last_message_at DESC)
+        WHERE status='unread' AND is_archived=0
+    """)
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_chats_followup_due ON chats(last_reply_at)
+        WHERE status='answered' AND is_archived=0 AND followup_done=0
+    """)
+    # Not partial: a second "is_archived=0" partial index would compete with idx_chats_unread
+    c.execute("DROP INDEX IF EXISTS idx_chats_prio_active")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_chats_priority ON chats(priority, is_archived, last_message_at DESC)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(next_retry_at) WHERE status='pending'")
     c.execute("CREATE INDEX IF NOT EXISTS idx_sent_messages ON sent_messages(user_id, topic_msg_id)")
     
+    # Full-text index over message content (trigram keeps LIKE's substring semantics)
+    global FTS_ENABLED
+    try:
+        existed = c.execute("SELECT 1 FROM sqlite_master WHERE name='messages_fts'").fetchone()
+        c.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+            USING fts5(content, content='messages', content_rowid='id', tokenize='trigram')
+        """)
+        c.executescript("""
+            CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+                INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            END;
+            CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+                INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+            END;
+        """)
+        if not existed:
+            c.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        FTS_ENABLED = True
+    except sqlite3.OperationalError as e:
+        logging.warning(f"FTS5 unavailable, search falls back to LIKE: {e}")
+    
+    # Give the planner statistics after migrations; job_optimize_db keeps them fresh
+    if not c.execute("SELECT 1 FROM sqlite_master WHERE name='sqlite_stat1'").fetchone():
+        c.execute("ANALYZE")
+    
     conn.commit()
-    conn.close()
     logging.info(f"Database initialized: {DB_PATH}")
 
+# ============================================================
+# SQL STATEMENTS (constant strings keep sqlite3's statement cache hot)
+# ============================================================
+
+SQL_CHAT_GET = "SELECT * FROM chats WHERE user_id=?"
+SQL_CHAT_GET_BY_TOPIC = "SELECT * FROM chats WHERE topic_id=?"
+SQL_CHAT_TOPIC_USERS = "SELECT topic_id, user_id FROM chats WHERE is_archived=0 AND topic_id IS NOT NULL"
+
+SQL_CHAT_CREATE = """
+    INSERT INTO chats (user_id, username, first_name, last_name, topic_id, last_message_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username=excluded.username, first_name=excluded.first_name, last_name=excluded.last_name,
+        topic_id=excluded.topic_id, is_archived=0, status='unread', unread_count=0
+    RETURNING *
+"""
+
+# unread_count is kept on the row: +1 per inbound message, reset by read/answered
+SQL_CHAT_NEW_MESSAGE = """
+    UPDATE chats SET 
+        status='unread', 
+        unread_count=unread_count+1,
+        last_message_preview=?, 
+        last_message_type=?, 
+        last_message_at=?,
+        followup_stage=0, 
+        followup_done=0,
+        snoozed_until=NULL
+    WHERE user_id=?
+    RETURNING *
+"""
+
+SQL_CHAT_MARK_ANSWERED = """
+    UPDATE chats SET 
+        status='answered', 
+        unread_count=0, 
+        last_reply_at=?,
+        followup_stage=0
+    WHERE user_id=?
+"""
+
+SQL_CHAT_MARK_READ = """
+    UPDATE chats SET 
+        status=CASE WHEN status='unread' THEN 'read' ELSE status END, 
+        unread_count=0 
+    WHERE user_id=?
+"""
+
+# Same rows as SQL_CHAT_UNREAD
+SQL_CHAT_MARK_ALL_READ = """
+    UPDATE chats SET status='read', unread_count=0
+    WHERE status='unread' AND is_archived=0
+        AND (snoozed_until IS NULL OR snoozed_until < ?)
+"""
+
+SQL_CHAT_MARK_UNREAD = """
+    UPDATE chats SET 
+        status='unread', 
+        unread_count=CASE WHEN unread_count=0 THEN 1 ELSE unread_count END 
+    WHERE user_id=?
+"""
+
+SQL_CHAT_SET_PRIORITY = "UPDATE chats SET priority=? WHERE user_id=?"
+
+# Variants for command handlers that render the updated row right away
+SQL_CHAT_MARK_ANSWERED_RETURNING = SQL_CHAT_MARK_ANSWERED + "RETURNING *"
+SQL_CHAT_MARK_READ_RETURNING = SQL_CHAT_MARK_READ + "RETURNING *"
+SQL_CHAT_MARK_UNREAD_RETURNING = SQL_CHAT_MARK_UNREAD + "RETURNING *"
+SQL_CHAT_SET_PRIORITY_RETURNING = SQL_CHAT_SET_PRIORITY + " RETURNING *"
+SQL_CHAT_ARCHIVE = "UPDATE chats SET is_archived=1, status='closed' WHERE user_id=?"
+SQL_CHAT_ARCHIVE_STALE = """
+    UPDATE chats SET is_archived=1, status='closed'
+    WHERE is_archived=0 AND last_message_at<?
+    RETURNING user_id, topic_id
+"""
+SQL_CHAT_SNOOZE = "UPDATE chats SET snoozed_until=? WHERE user_id=?"
+SQL_CHAT_DONE_FOLLOWUP = "UPDATE chats SET followup_done=1 WHERE user_id=?"
+
+SQL_CHAT_UNREAD = """
+    SELECT * FROM chats 
+    WHERE status='unread' AND is_archived=0 
+        AND (snoozed_until IS NULL OR snoozed_until < ?)
+    ORDER BY 
+        CASE priority WHEN 'urgent' THEN 0 WHEN 'vip' THEN 1 ELSE 2 END,
+        last_message_at DESC
+"""
+
+SQL_CHAT_ALL_ACTIVE = """
+    SELECT * FROM chats WHERE is_archived=0 
+    ORDER BY last_message_at DESC
+"""
+
+SQL_CHAT_BY_PRIORITY = """
+    SELECT * FROM chats WHERE is_archived=0 AND priority=?
+    ORDER BY last_message_at DESC
+"""
+
+# Bucketing happens in SQL: age is hours since reply divided by the threshold
+# Answered chats past their follow-up threshold, with age (in thresholds) and bucket.
+# Shared by every follow-up query; params: now, VIP hours, normal hours
+FOLLOWUP_BUCKETS = """
+    SELECT *, CASE
+            WHEN age >= 3 THEN 'overdue'
+            WHEN age >= 1.5 THEN 'urgent'
+            ELSE 'due'
+        END AS bucket
+    FROM (
+        SELECT *, (? - last_reply_at) / 3600.0
+            / CASE priority WHEN 'vip' THEN ? ELSE ? END AS age
+        FROM chats 
+        WHERE status='answered' AND is_archived=0 AND followup_done=0
+            AND last_reply_at IS NOT NULL
+    )
+    WHERE age >= 1
+"""
+
+SQL_CHAT_FOLLOWUPS_DUE = f"""
+    {FOLLOWUP_BUCKETS}
+    ORDER BY last_reply_at ASC
+"""
+
+# Narrow projections for listings (unpacked positionally in the same order)
+CHAT_BRIEF_COLUMNS = """
+    user_id, first_name, last_name, username, priority, status,
+    last_message_preview, last_message_at, last_reply_at, topic_id
+"""
+
+SQL_CHAT_UNREAD_BRIEF = f"""
+    SELECT {CHAT_BRIEF_COLUMNS} FROM chats 
+    WHERE status='unread' AND is_archived=0 
+        AND (snoozed_until IS NULL OR snoozed_until < ?)
+    ORDER BY 
+        CASE priority WHEN 'urgent' THEN 0 WHEN 'vip' THEN 1 ELSE 2 END,
+        last_message_at DESC
+"""
+
+SQL_CHAT_ALL_ACTIVE_BRIEF = f"""
+    SELECT {CHAT_BRIEF_COLUMNS} FROM chats WHERE is_archived=0 
+    ORDER BY last_message_at DESC
+"""
+
+SQL_CHAT_FOLLOWUPS_DUE_BRIEF = f"""
+    SELECT bucket, {CHAT_BRIEF_COLUMNS}
+    FROM ({FOLLOWUP_BUCKETS})
+    ORDER BY last_reply_at ASC
+"""
+
+# First rows of each bucket plus the overall count, for the morning report
+SQL_CHAT_FOLLOWUPS_TOP = f"""
+    SELECT bucket, total, user_id, first_name, last_name, username, priority
+    FROM (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY bucket ORDER BY last_reply_at) AS rn,
+            COUNT(*) OVER () AS total
+        FROM ({FOLLOWUP_BUCKETS})
+    )
+    WHERE rn <= ?
+    ORDER BY last_reply_at ASC
+"""
+
+SQL_LOG_MESSAGE = """
+    INSERT INTO messages (user_id, direction, msg_type, content, file_id, telegram_msg_id)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# Ring buffer: overwrite the oldest of the user's 100 slots, no trimming needed
+SQL_MAPPING_NEXT_SEQ = "UPDATE chats SET msg_seq=msg_seq+1 WHERE user_id=?"
+SQL_MAPPING_SAVE = """
+    INSERT OR REPLACE INTO sent_messages (user_id, slot, seq, topic_msg_id, user_msg_id)
+    SELECT user_id, msg_seq % 100, msg_seq, ?, ? FROM chats WHERE user_id=?
+"""
+
+SQL_MAPPING_GET = "SELECT user_msg_id FROM sent_messages WHERE user_id=? AND topic_msg_id=?"
+SQL_MAPPING_LAST = """
+    SELECT user_msg_id FROM sent_messages 
+    WHERE user_id=? 
+    ORDER BY seq DESC LIMIT ?
+"""
+
+SQL_NOTE_ADD = "INSERT INTO notes (user_id, note) VALUES (?, ?)"
+SQL_NOTES_RECENT = "SELECT note, created_at FROM notes WHERE user_id=? ORDER BY created_at DESC LIMIT 3"
+
+SQL_SEQUENCE_LIST = "SELECT name, COUNT(*) FROM sequences GROUP BY name ORDER BY name"
+SQL_SEQUENCE_GET = "SELECT original_chat_id, original_msg_id FROM sequences WHERE name=? ORDER BY position"
+SQL_SEQUENCE_ADD = """
+    INSERT INTO sequences (name, position, original_chat_id, original_msg_id)
+    VALUES (?, ?, ?, ?)
+"""
+SQL_SEQUENCE_DELETE = "DELETE FROM sequences WHERE name=?"
+
+SQL_TOPIC_CACHE_LOAD = "SELECT topic_id, topic_name FROM topic_cache"
+SQL_TOPIC_CACHE_UPSERT = """
+    INSERT INTO topic_cache (topic_id, topic_name, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT(topic_id) DO UPDATE SET topic_name=excluded.topic_name, updated_at=excluded.updated_at
+"""
+
+SQL_SEARCH_FTS = """
+    SELECT m.content, m.direction, c.first_name, c.topic_id
+    FROM messages_fts f
+    JOIN messages m ON m.id=f.rowid
+    JOIN chats c ON m.user_id=c.user_id
+    WHERE messages_fts MATCH ?
+    ORDER BY m.created_at DESC LIMIT 10
+"""
+
+SQL_SEARCH_LIKE = """
+    SELECT m.content, m.direction, c.first_name, c.topic_id
+    FROM messages m 
+    JOIN chats c ON m.user_id=c.user_id 
+    WHERE m.content LIKE ? 
+    ORDER BY m.created_at DESC LIMIT 10
+"""
+
+SQL_OUTBOX_ADD = """
+    INSERT INTO outbox (direction, from_chat_id, to_chat_id, message_id, topic_id, next_retry_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+SQL_OUTBOX_PENDING = """
+    SELECT * FROM outbox 
+    WHERE status='pending' AND next_retry_at <= ?
+    ORDER BY created_at ASC
+    LIMIT 20
+"""
+
+SQL_OUTBOX_MARK_SENT = "UPDATE outbox SET status='sent' WHERE id=?"
+
+# Count the attempt and reschedule with exponential backoff (5s, 15s, 45s, 2m, 5m, 15m, max 1h),
+# give up after 10 attempts. Right-hand sides see the old retry_count.
+SQL_OUTBOX_FAIL = """
+    UPDATE outbox SET
+        retry_count=retry_count+1,
+        status=CASE WHEN retry_count+1 >= 10 THEN 'failed' ELSE status END,
+        next_retry_at=CASE WHEN retry_count+1 >= 10 THEN next_retry_at
+            ELSE ? + CASE retry_count+1
+                WHEN 1 THEN 5 WHEN 2 THEN 15 WHEN 3 THEN 45
+                WHEN 4 THEN 120 WHEN 5 THEN 300 WHEN 6 THEN 900
+                ELSE 3600 END
+            END,
+        error=?
+    WHERE id=?
+"""
+
 # ============================================================
 # CHAT MANAGER
 # ============================================================
 
+# Short-lived row cache for message bursts: user_id -> (chat, expires_at)
+CHAT_CACHE = {}
+# topic_id -> user_id of active chats: warmed at startup, set whenever an active row is
+# cached, popped for archived rows; a plain dict, single get/set/pop need no lock
+TOPIC_USER_CACHE = {}
+
+def cache_chat(chat: Optional[Dict]) -> Optional[Dict]:
+    if chat:
+        CHAT_CACHE[chat['user_id']] = (chat, time.monotonic() + CHAT_CACHE_TTL_SECONDS)
+        if chat['is_archived']:
+            TOPIC_USER_CACHE.pop(chat['topic_id'], None)
+        else:
+            TOPIC_USER_CACHE[chat['topic_id']] = chat['user_id']
+    return chat
+
+# Listings are memoized per CHAT_VERSION; every chat write bumps it
+CHAT_VERSION = 0
+
+def bump_chat_version():
+    global CHAT_VERSION
+    CHAT_VERSION += 1
+
+def invalidate_chat(user_id: int = None):
+    """Drop one cached chat, or all of them"""
+    bump_chat_version()
+    if user_id is None:
+        CHAT_CACHE.clear()
+    else:
+        CHAT_CACHE.pop(user_id, None)
+
+@functools.lru_cache(maxsize=4)
+def chat_listing_rows(sql: str, timed: bool, version: int, slot: int) -> tuple:
+    """(column names, rows) of a listing query as tuples, reused until the next chat write or time slot"""
+    c = get_db().execute(sql, (int(time.time()),) if timed else ())
+    return tuple(col[0] for col in c.description), tuple(c.fetchall())
+
+def list_slot() -> int:
+    return int(time.monotonic() // CHAT_LIST_CACHE_SECONDS)
+
+def chat_listing(sql: str, brief: bool, timed: bool) -> List:
+    """Cached listing as a fresh list (tuples if brief, dicts otherwise), callers may modify it"""
+    columns, rows = chat_listing_rows(sql, timed, CHAT_VERSION, list_slot())
+    if brief:
+        return list(rows)
+    return [dict(zip(columns, row)) for row in rows]
+
+async def update_chat_returning(sql: str, params: tuple) -> Optional[Dict]:
+    """Run a chat write ... RETURNING * on the DB writer thread and cache the new row"""
+    row = await run_db(write_returning, sql, params)
+    bump_chat_version()
+    return cache_chat(row)
+
 class Chat:
     @staticmethod
     def get(user_id: int) -> Optional[Dict]:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("SELECT * FROM chats WHERE user_id=?", (user_id,))
-        row = c.fetchone()
-        conn.close()
-        return dict(row) if row else None
+        cached = CHAT_CACHE.get(user_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        return cache_chat(dict_cursor().execute(SQL_CHAT_GET, (user_id,)).fetchone())
 
     @staticmethod
     def get_by_topic(topic_id: int) -> Optional[Dict]:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("SELECT * FROM chats WHERE topic_id=?", (topic_id,))
-        row = c.fetchone()
-        conn.close()
-        return dict(row) if row else None
+        user_id = TOPIC_USER_CACHE.get(topic_id)
+        if user_id is not None:
+            chat = Chat.get(user_id)
+            if chat and chat['topic_id'] == topic_id:
+                return chat
+        return cache_chat(dict_cursor().execute(SQL_CHAT_GET_BY_TOPIC, (topic_id,)).fetchone())
 
     @staticmethod
-    def create(user_id: int, username: str, first_name: str, last_name: str, topic_id: int):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO chats (user_id, username, first_name, last_name, topic_id, last_message_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-                username=excluded.username, first_name=excluded.first_name, last_name=excluded.last_name,
-                topic_id=excluded.topic_id, is_archived=0, status='unread', unread_count=1
-        """, (user_id, username, first_name, last_name, topic_id, datetime.now()))
-        conn.commit()
-        conn.close()
+    async def create(user_id: int, username: str, first_name: str, last_name: str, topic_id: int, now: int = None) -> Dict:
+        """Create (or reopen) a chat and return the resulting row"""
+        return await update_chat_returning(
+            SQL_CHAT_CREATE, (user_id, username, first_name, last_name, topic_id, now or int(time.time()))
+        )
 
     @staticmethod
-    def new_message(user_id: int, preview: str, msg_type: str):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            UPDATE chats SET 
-                status='unread', 
-                unread_count=unread_count+1,
-                last_message_preview=?, 
-                last_message_type=?, 
-                last_message_at=?,
-                followup_stage=0, 
-                followup_done=0,
-                snoozed_until=NULL
-            WHERE user_id=?
-        """, (preview[:100], msg_type, datetime.now(), user_id))
-        conn.commit()
-        conn.close()
+    async def mark_answered(user_id: int, now: int = None) -> Optional[Dict]:
+        return await update_chat_returning(SQL_CHAT_MARK_ANSWERED_RETURNING, (now or int(time.time()), user_id))
 
     @staticmethod
-    def mark_answered(user_id: int):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            UPDATE chats SET 
-                status='answered', 
-                unread_count=0, 
-                last_reply_at=?,
-                followup_stage=0
-            WHERE user_id=?
-        """, (datetime.now(), user_id))
-        conn.commit()
-        conn.close()
+    async def mark_read(user_id: int) -> Optional[Dict]:
+        return await update_chat_returning(SQL_CHAT_MARK_READ_RETURNING, (user_id,))
 
     @staticmethod
-    def mark_read(user_id: int):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            UPDATE chats SET 
-                status=CASE WHEN status='unread' THEN 'read' ELSE status END, 
-                unread_count=0 
-            WHERE user_id=?
-        """, (user_id,))
-        conn.commit()
-        conn.close()
+    async def mark_all_read() -> int:
+        """Mark every unread chat read in one statement, return how many changed"""
+        count = await run_db(write_one, SQL_CHAT_MARK_ALL_READ, (int(time.time()),))
+        invalidate_chat()
+        return count
 
     @staticmethod
-    def mark_unread(user_id: int):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            UPDATE chats SET 
-                status='unread', 
-                unread_count=CASE WHEN unread_count=0 THEN 1 ELSE unread_count END 
-            WHERE user_id=?
-        """, (user_id,))
-        conn.commit()
-        conn.close()
+    async def mark_unread(user_id: int) -> Optional[Dict]:
+        return await update_chat_returning(SQL_CHAT_MARK_UNREAD_RETURNING, (user_id,))
 
     @staticmethod
-    def set_priority(user_id: int, priority: str):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("UPDATE chats SET priority=? WHERE user_id=?", (priority, user_id))
-        conn.commit()
-        conn.close()
+    async def set_priority(user_id: int, priority: str) -> Optional[Dict]:
+        return await update_chat_returning(SQL_CHAT_SET_PRIORITY_RETURNING, (priority, user_id))
 
     @staticmethod
-    def archive(user_id: int):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("UPDATE chats SET is_archived=1, status='closed' WHERE user_id=?", (user_id,))
-        conn.commit()
-        conn.close()
+    async def archive(user_id: int):
+        await run_db(write_one, SQL_CHAT_ARCHIVE, (user_id,))
+        invalidate_chat(user_id)
 
     @staticmethod
-    def snooze(user_id: int, hours: int):
-        conn = get_db()
-        c = conn.cursor()
-        until = datetime.now() + timedelta(hours=hours)
-        c.execute("UPDATE chats SET snoozed_until=? WHERE user_id=?", (until, user_id))
-        conn.commit()
-        conn.close()
+    async def snooze(user_id: int, hours: int, now: int = None):
+        until = (now or int(time.time())) + hours * 3600
+        await run_db(write_one, SQL_CHAT_SNOOZE, (until, user_id))
+        invalidate_chat(user_id)
 
     @staticmethod
-    def done_followup(user_id: int):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("UPDATE chats SET followup_done=1 WHERE user_id=?", (user_id,))
-        conn.commit()
-        conn.close()
+    async def done_followup(user_id: int):
+        await run_db(write_one, SQL_CHAT_DONE_FOLLOWUP, (user_id,))
+        invalidate_chat(user_id)
 
     @staticmethod
-    def get_unread() -> List[Dict]:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            SELECT * FROM chats 
-            WHERE status='unread' AND is_archived=0 
-                AND (snoozed_until IS NULL OR snoozed_until < ?)
-            ORDER BY 
-                CASE priority WHEN 'urgent' THEN 0 WHEN 'vip' THEN 1 ELSE 2 END,
-                last_message_at DESC
-        """, (datetime.now(),))
-        rows = c.fetchall()
-        conn.close()
-        return [dict(r) for r in rows]
+    def get_unread(now: int = None) -> List[Dict]:
+        if now:
+            return dict_cursor().execute(SQL_CHAT_UNREAD, (now,)).fetchall()
+        return chat_listing(SQL_CHAT_UNREAD, False, True)
 
     @staticmethod
     def get_all_active() -> List[Dict]:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            SELECT * FROM chats WHERE is_archived=0 
-            ORDER BY last_message_at DESC
-        """)
-        rows = c.fetchall()
-        conn.close()
-        return [dict(r) for r in rows]
+        return chat_listing(SQL_CHAT_ALL_ACTIVE, False, False)
 
     @staticmethod
-    def get_followups_due() -> Dict[str, List[Dict]]:
+    def get_by_priority(priority: str) -> List[Dict]:
+        return dict_cursor().execute(SQL_CHAT_BY_PRIORITY, (priority,)).fetchall()
+
+    @staticmethod
+    def get_followups_due(now: int = None) -> Dict[str, List[Dict]]:
         """Get follow-ups grouped by urgency"""
-        conn = get_db()
-        c = conn.cursor()
-        now = datetime.now()
-        
         results = {'due': [], 'urgent': [], 'overdue': []}
         
-        c.execute("""
-            SELECT * FROM chats 
-            WHERE status='answered' AND is_archived=0 AND followup_done=0
-                AND last_reply_at IS NOT NULL
-            ORDER BY last_reply_at ASC
-        """)
+        rows = dict_cursor().execute(
+            SQL_CHAT_FOLLOWUPS_DUE, (now or int(time.time()), FOLLOWUP_HOURS_VIP, FOLLOWUP_HOURS_NORMAL)
+        ).fetchall()
         
-        for row in c.fetchall():
-            chat = dict(row)
-            hours_since = (now - chat['last_reply_at']).total_seconds() / 3600
-            threshold = FOLLOWUP_HOURS_VIP if chat['priority'] == 'vip' else FOLLOWUP_HOURS_NORMAL
-            
-            if hours_since >= threshold * 3:  # 3x threshold = overdue
-                results['overdue'].append(chat)
-            elif hours_since >= threshold * 1.5:  # 1.5x = urgent
-                results['urgent'].append(chat)
-            elif hours_since >= threshold:  # 1x = due
-                results['due'].append(chat)
+        for chat in rows:
+            del chat['age']
+            results[chat.pop('bucket')].append(chat)
         
-        conn.close()
         return results
 
+    @staticmethod
+    def get_unread_brief(now: int = None) -> List[tuple]:
+        """Unread chats as CHAT_BRIEF_COLUMNS tuples"""
+        if now:
+            return get_db().execute(SQL_CHAT_UNREAD_BRIEF, (now,)).fetchall()
+        return chat_listing(SQL_CHAT_UNREAD_BRIEF, True, True)
+
+    @staticmethod
+    def get_all_active_brief() -> List[tuple]:
+        """Active chats as CHAT_BRIEF_COLUMNS tuples"""
+        return chat_listing(SQL_CHAT_ALL_ACTIVE_BRIEF, True, False)
+
+    @staticmethod
+    def get_followups_due_brief(now: int = None) -> Dict[str, List[tuple]]:
+        """Follow-ups grouped by urgency as CHAT_BRIEF_COLUMNS tuples"""
+        results = {'due': [], 'urgent': [], 'overdue': []}
+        rows = get_db().execute(
+            SQL_CHAT_FOLLOWUPS_DUE_BRIEF, (now or int(time.time()), FOLLOWUP_HOURS_VIP, FOLLOWUP_HOURS_NORMAL)
+        ).fetchall()
+        for row in rows:
+            results[row[0]].append(row[1:])
+        return results
+
+    @staticmethod
+    def get_followups_top(limit_per_stage: int, now: int = None) -> tuple:
+        """(total due, {bucket: first rows as (user_id, first, last, username, priority)})"""
+        results = {'due': [], 'urgent': [], 'overdue': []}
+        total = 0
+        rows = get_db().execute(
+            SQL_CHAT_FOLLOWUPS_TOP, (now or int(time.time()), FOLLOWUP_HOURS_VIP, FOLLOWUP_HOURS_NORMAL, limit_per_stage)
+        ).fetchall()
+        for bucket, total, *row in rows:
+            results[bucket].append(tuple(row))
+        return total, results
+
+    @staticmethod
+    def write_incoming(user_id: int, preview: str, msg_type: str, telegram_msg_id: int, now: int) -> Optional[Dict]:
+        """Log an inbound message and update the chat in one transaction (DB writer thread)"""
+        conn = get_db()
+        with conn:
+            row = dict_cursor().execute(SQL_CHAT_NEW_MESSAGE, (preview[:100], msg_type, now, user_id)).fetchone()
+            conn.execute(SQL_LOG_MESSAGE, (user_id, "in", msg_type, preview[:100], "", telegram_msg_id))
+        return row
+
+    @staticmethod
+    def write_outgoing(user_id: int, preview: str, msg_type: str, topic_msg_id: int, user_msg_id: int, now: int) -> Optional[Dict]:
+        """Save deletion mapping, log an outbound message and mark answered in one transaction (DB writer thread)"""
+        conn = get_db()
+        with conn:
+            conn.execute(SQL_MAPPING_NEXT_SEQ, (user_id,))
+            conn.execute(SQL_MAPPING_SAVE, (topic_msg_id, user_msg_id, user_id))
+            conn.execute(SQL_LOG_MESSAGE, (user_id, "out", msg_type, preview[:100], "", user_msg_id))
+            return dict_cursor().execute(SQL_CHAT_MARK_ANSWERED_RETURNING, (now, user_id)).fetchone()
+
+    @staticmethod
+    async def record_incoming(user_id: int, preview: str, msg_type: str, telegram_msg_id: int, now: int = None) -> Optional[Dict]:
+        """Write an inbound message off the event loop, return the updated row"""
+        row = await run_db(Chat.write_incoming, user_id, preview, msg_type, telegram_msg_id, now or int(time.time()))
+        bump_chat_version()
+        return cache_chat(row)
+
+    @staticmethod
+    async def record_outgoing(user_id: int, preview: str, msg_type: str, topic_msg_id: int, user_msg_id: int, now: int = None) -> Optional[Dict]:
+        """Write an outbound message off the event loop, return the updated row"""
+        row = await run_db(Chat.write_outgoing, user_id, preview, msg_type, topic_msg_id, user_msg_id, now or int(time.time()))
+        bump_chat_version()
+        return cache_chat(row)
+
 # ============================================================
 # OUTBOX (Reliable Delivery)
 # ============================================================
@@ -387,108 +915,101 @@ class Outbox:
     def add(direction: str, from_chat_id: int, to_chat_id: int, message_id: int, topic_id: int = None):
         """Add message to outbox for reliable delivery"""
         conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO outbox (direction, from_chat_id, to_chat_id, message_id, topic_id, next_retry_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (direction, from_chat_id, to_chat_id, message_id, topic_id, datetime.now()))
+        conn.execute(SQL_OUTBOX_ADD, (direction, from_chat_id, to_chat_id, message_id, topic_id, int(time.time())))
         conn.commit()
-        conn.close()
 
     @staticmethod
-    def get_pending() -> List[Dict]:
-        """Get messages ready for retry"""
+    def add_many(rows: List[tuple]):
+        """Add several (direction, from_chat_id, to_chat_id, message_id, topic_id) rows in one transaction"""
+        now = int(time.time())
         conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            SELECT * FROM outbox 
-            WHERE status='pending' AND next_retry_at <= ?
-            ORDER BY created_at ASC
-            LIMIT 20
-        """, (datetime.now(),))
-        rows = c.fetchall()
-        conn.close()
-        return [dict(r) for r in rows]
+        with conn:
+            conn.executemany(SQL_OUTBOX_ADD, [row + (now,) for row in rows])
 
     @staticmethod
-    def mark_sent(outbox_id: int):
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("UPDATE outbox SET status='sent' WHERE id=?", (outbox_id,))
-        conn.commit()
-        conn.close()
+    def get_pending() -> List[Dict]:
+        """Get messages ready for retry"""
+        return dict_cursor().execute(SQL_OUTBOX_PENDING, (int(time.time()),)).fetchall()
 
     @staticmethod
-    def mark_failed(outbox_id: int, error: str):
-        """Mark as failed with exponential backoff"""
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("SELECT retry_count FROM outbox WHERE id=?", (outbox_id,))
-        row = c.fetchone()
-        retry_count = row[0] + 1 if row else 1
-        
-        # Exponential backoff: 5s, 15s, 45s, 2m, 5m, 15m, max 1h
-        delays = [5, 15, 45, 120, 300, 900, 3600]
-        delay = delays[min(retry_count - 1, len(delays) - 1)]
-        next_retry = datetime.now() + timedelta(seconds=delay)
-        
-        if retry_count >= 10:
-            c.execute("UPDATE outbox SET status='failed', error=?, retry_count=? WHERE id=?",
-                      (error, retry_count, outbox_id))
-        else:
-            c.execute("UPDATE outbox SET retry_count=?, next_retry_at=?, error=? WHERE id=?",
-                      (retry_count, next_retry, error, outbox_id))
+    def apply_results(results: List[tuple]):
+        """Store the outcome of a drain run, (item, error or None) per row, in one transaction"""
+        if not results:
+            return
+        now = int(time.time())
+        sent = [(item['id'],) for item, error in results if error is None]
+        failed = [(now, error, item['id']) for item, error in results if error is not None]
         
-        conn.commit()
-        conn.close()
+        conn = get_db()
+        with conn:
+            conn.executemany(SQL_OUTBOX_MARK_SENT, sent)
+            conn.executemany(SQL_OUTBOX_FAIL, failed)
 
 # ============================================================
 # TOPIC CACHE (Warm Start)
 # ============================================================
 
 TOPIC_NAME_CACHE = {}
+TOPIC_STATE_CACHE = {}  # topic_id -> fingerprint of the fields the name is built from
+
+# Names are reconstructable from chat state, so the DB copy is written behind
+DIRTY_TOPICS = set()
 
 def load_topic_cache():
     """Load topic names from DB on startup"""
-    global TOPIC_NAME_CACHE
     try:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("SELECT topic_id, topic_name FROM topic_cache")
-        for row in c.fetchall():
-            TOPIC_NAME_CACHE[row[0]] = row[1]
-        conn.close()
+        # Rows are (topic_id, topic_name) pairs, dict.update consumes the cursor directly
+        TOPIC_NAME_CACHE.update(get_db().execute(SQL_TOPIC_CACHE_LOAD))
         logging.info(f"Loaded {len(TOPIC_NAME_CACHE)} topics from cache")
+        # topic_id -> user_id for active chats, so admin replies skip the topic lookup
+        TOPIC_USER_CACHE.update(get_db().execute(SQL_CHAT_TOPIC_USERS))
     except:
         pass
 
 def save_topic_cache(topic_id: int, topic_name: str):
-    """Save topic name to cache"""
+    """Save topic name to cache (persisted on next flush)"""
     TOPIC_NAME_CACHE[topic_id] = topic_name
+    DIRTY_TOPICS.add(topic_id)
+
+def take_dirty_topics() -> List[tuple]:
+    """Hand over changed topic names as upsert rows"""
+    now = int(time.time())
+    rows = [(tid, TOPIC_NAME_CACHE[tid], now) for tid in DIRTY_TOPICS]
+    DIRTY_TOPICS.clear()
+    return rows
+
+def write_topic_cache(rows: List[tuple]):
+    """Persist topic names in one transaction"""
+    if not rows:
+        return
     try:
         conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO topic_cache (topic_id, topic_name, updated_at) VALUES (?, ?, ?)
-            ON CONFLICT(topic_id) DO UPDATE SET topic_name=excluded.topic_name, updated_at=excluded.updated_at
-        """, (topic_id, topic_name, datetime.now()))
-        conn.commit()
-        conn.close()
-    except:
-        pass
+        with conn:
+            conn.executemany(SQL_TOPIC_CACHE_UPSERT, rows)
+    except Exception as e:
+        logging.warning(f"Topic cache flush failed: {e}")
+
+def flush_topic_cache():
+    """Persist changed topic names right now on the calling thread"""
+    write_topic_cache(take_dirty_topics())
 
 # ============================================================
 # HELPERS
 # ============================================================
 
-def get_name(chat: Dict) -> str:
-    parts = [chat.get('first_name', ''), chat.get('last_name', '')]
-    parts = [p for p in parts if p]
+# Keyed by the name fields themselves, so a renamed user simply gets a new entry
+@functools.lru_cache(maxsize=2048)
+def format_name(first_name: str, last_name: str, username: str, user_id) -> str:
+    parts = [p for p in (first_name, last_name) if p]
     if parts:
         return " ".join(parts)
-    if chat.get('username'):
-        return f"@{chat['username']}"
-    return f"User {chat.get('user_id', '?')}"
+    if username:
+        return f"@{username}"
+    return f"User {user_id}"
+
+def get_name(chat: Dict) -> str:
+    return format_name(chat.get('first_name', ''), chat.get('last_name', ''),
+                       chat.get('username'), chat.get('user_id', '?'))
 
 def get_topic_name(chat: Dict) -> str:
     name = get_name(chat)
@@ -497,50 +1018,80 @@ def get_topic_name(chat: Dict) -> str:
     parts = [x for x in [p, s, name] if x]
     return " ".join(parts)[:128]
 
-def time_ago(dt) -> str:
-    if not dt:
+def time_ago(ts: Optional[int]) -> str:
+    if not ts:
         return ""
-    if isinstance(dt, str):
-        dt = datetime.fromisoformat(dt)
-    delta = datetime.now() - dt
-    if delta.days > 0:
-        return f"vor {delta.days}d"
-    hours = delta.seconds // 3600
+    seconds = max(0, int(time.time()) - ts)
+    days = seconds // 86400
+    if days > 0:
+        return f"vor {days}d"
+    hours = seconds // 3600
     if hours > 0:
         return f"vor {hours}h"
-    minutes = delta.seconds // 60
+    minutes = seconds // 60
     if minutes > 0:
         return f"vor {minutes}min"
     return "gerade"
 
+def format_ts(ts: Optional[int]) -> str:
+    if not ts:
+        return "?"
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M")
+
 def log_msg(user_id: int, direction: str, msg_type: str, content: str = "", file_id: str = "", telegram_msg_id: int = None):
-    try:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO messages (user_id, direction, msg_type, content, file_id, telegram_msg_id)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (user_id, direction, msg_type, content[:500] if content else "", file_id, telegram_msg_id))
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        logging.error(f"Failed to log message: {e}")
+    # Fire and forget: the writer thread commits it, the send never waits on the log
+    submit_db(write_one, SQL_LOG_MESSAGE, (user_id, direction, msg_type, content[:500] if content else "", file_id, telegram_msg_id))
 
 # ============================================================
 # TOPIC MANAGEMENT
 # ============================================================
 
+# Debounced renames: topic_id -> latest chat state to apply
+PENDING_TOPIC_UPDATES = {}
+TOPIC_UPDATE_TASKS = set()
+
+def topic_fingerprint(chat: Dict) -> tuple:
+    return (chat.get('status'), chat.get('priority'), chat.get('first_name'),
+            chat.get('last_name'), chat.get('username'))
+
 async def update_topic(bot: Bot, chat: Dict):
-    """Update topic name with status"""
+    """Schedule a topic rename if the name-relevant fields changed"""
     if not chat:
         return
     
+    topic_id = chat['topic_id']
+    
+    # A rename is already scheduled: just refresh its target state
+    if topic_id in PENDING_TOPIC_UPDATES:
+        PENDING_TOPIC_UPDATES[topic_id] = chat
+        return
+    
+    # Skip if unchanged
+    if TOPIC_STATE_CACHE.get(topic_id) == topic_fingerprint(chat):
+        return
+    
+    PENDING_TOPIC_UPDATES[topic_id] = chat
+    task = asyncio.create_task(apply_topic_update(bot, topic_id))
+    TOPIC_UPDATE_TASKS.add(task)
+    task.add_done_callback(TOPIC_UPDATE_TASKS.discard)
+
+async def apply_topic_update(bot: Bot, topic_id: int):
+    """Rename topic once after the debounce window"""
+    await asyncio.sleep(TOPIC_UPDATE_DELAY_SECONDS)
+    chat = PENDING_TOPIC_UPDATES.pop(topic_id, None)
+    if not chat:
+        return
+    
+    fingerprint = topic_fingerprint(chat)
+    if TOPIC_STATE_CACHE.get(topic_id) == fingerprint:
+        return
+    
     try:
         topic_name = get_topic_name(chat)
-        topic_id = chat['topic_id']
         
-        # Skip if unchanged
+        # Name from warm-start cache already matches
         if TOPIC_NAME_CACHE.get(topic_id) == topic_name:
+            TOPIC_STATE_CACHE[topic_id] = fingerprint
             return
         
         await bot.edit_forum_topic(
@@ -549,15 +1100,18 @@ async def update_topic(bot: Bot, chat: Dict):
             name=topic_name
         )
         save_topic_cache(topic_id, topic_name)
+        TOPIC_STATE_CACHE[topic_id] = fingerprint
         
     except BadRequest as e:
-        if "not modified" not in str(e).lower():
+        if "not modified" in str(e).lower():
+            TOPIC_STATE_CACHE[topic_id] = fingerprint
+        else:
             logging.warning(f"Topic update failed: {e}")
     except Exception as e:
         logging.warning(f"Topic update error: {e}")
 
-async def create_topic(bot: Bot, user) -> int:
-    """Create new topic for user"""
+async def create_topic(bot: Bot, user, now: int = None) -> Dict:
+    """Create new topic for user, return the chat row"""
     name = get_name({
         'first_name': user.first_name,
         'last_name': user.last_name,
@@ -570,16 +1124,17 @@ async def create_topic(bot: Bot, user) -> int:
         name=topic_name
     )
     
-    Chat.create(
+    chat = await Chat.create(
         user.id,
         user.username or "",
         user.first_name or "",
         user.last_name or "",
-        topic.message_thread_id
+        topic.message_thread_id,
+        now
     )
     
     save_topic_cache(topic.message_thread_id, topic_name)
-    return topic.message_thread_id
+    return chat
 
 async def delete_service_messages(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Delete 'topic renamed' service messages"""
@@ -593,8 +1148,8 @@ async def delete_service_messages(update: Update, ctx: ContextTypes.DEFAULT_TYPE
 # MESSAGE FORWARDING (copy_message for native experience)
 # ============================================================
 
-async def forward_to_topic(bot: Bot, msg: Message, topic_id: int, user_id: int) -> bool:
-    """Forward user message to topic using copy_message"""
+async def forward_to_topic(bot: Bot, msg: Message, topic_id: int, user_id: int, now: int = None) -> Optional[Dict]:
+    """Forward user message to topic using copy_message, return the updated chat row"""
     try:
         sent = await bot.copy_message(
             chat_id=SUPPORT_GROUP_ID,
@@ -602,75 +1157,103 @@ async def forward_to_topic(bot: Bot, msg: Message, topic_id: int, user_id: int)
             message_id=msg.message_id,
             message_thread_id=topic_id
         )
-        
-        # Log
-        preview = msg.text or msg.caption or f"[{msg.content_type}]"
-        log_msg(user_id, "in", msg.content_type or "unknown", preview[:100], telegram_msg_id=sent.message_id)
-        Chat.new_message(user_id, preview[:100], msg.content_type or "unknown")
-        
-        return True
     except Exception as e:
         logging.error(f"Forward to topic failed: {e}")
         # Add to outbox for retry
-        Outbox.add("to_topic", msg.chat_id, SUPPORT_GROUP_ID, msg.message_id, topic_id)
-        return False
+        await run_db(Outbox.add, "to_topic", msg.chat_id, SUPPORT_GROUP_ID, msg.message_id, topic_id)
+        return None
+    
+    # Log + chat update; the message is delivered, so a DB error must not queue a resend
+    preview = msg.text or msg.caption or f"[{msg.content_type}]"
+    try:
+        return await Chat.record_incoming(user_id, preview, msg.content_type or "unknown", sent.message_id, now)
+    except Exception as e:
+        logging.error(f"Recording forwarded message failed: {e}")
+        return Chat.get(user_id)
 
-async def forward_to_user(bot: Bot, msg: Message, user_id: int, topic_id: int) -> Optional[int]:
-    """Forward admin message to user using copy_message"""
+async def forward_to_user(bot: Bot, msg: Message, user_id: int, topic_id: int, now: int = None) -> Optional[Dict]:
+    """Forward admin message to user using copy_message, return the updated chat row"""
     try:
         sent = await bot.copy_message(
             chat_id=user_id,
             from_chat_id=msg.chat_id,
             message_id=msg.message_id
         )
-        
-        # Save mapping for deletion
-        save_message_mapping(user_id, msg.message_id, sent.message_id)
-        
-        # Log
-        preview = msg.text or msg.caption or f"[{msg.content_type}]"
-        log_msg(user_id, "out", msg.content_type or "unknown", preview[:100], telegram_msg_id=sent.message_id)
-        Chat.mark_answered(user_id)
-        
-        return sent.message_id
     except Exception as e:
         logging.error(f"Forward to user failed: {e}")
         # Add to outbox for retry
-        Outbox.add("to_user", msg.chat_id, user_id, msg.message_id, topic_id)
+        await run_db(Outbox.add, "to_user", msg.chat_id, user_id, msg.message_id, topic_id)
         return None
-
-def save_message_mapping(user_id: int, topic_msg_id: int, user_msg_id: int):
-    """Save mapping for message deletion"""
+    
+    # Mapping for deletion + log + answered; a DB error must not queue a resend
+    preview = msg.text or msg.caption or f"[{msg.content_type}]"
     try:
-        conn = get_db()
-        c = conn.cursor()
-        c.execute("""
-            INSERT INTO sent_messages (user_id, topic_msg_id, user_msg_id)
-            VALUES (?, ?, ?)
-        """, (user_id, topic_msg_id, user_msg_id))
-        # Keep only last 100 per user
-        c.execute("""
-            DELETE FROM sent_messages WHERE user_id=? AND id NOT IN 
-            (SELECT id FROM sent_messages WHERE user_id=? ORDER BY id DESC LIMIT 100)
-        """, (user_id, user_id))
-        conn.commit()
-        conn.close()
-    except:
-        pass
+        return await Chat.record_outgoing(user_id, preview, msg.content_type or "unknown", msg.message_id, sent.message_id, now)
+    except Exception as e:
+        logging.error(f"Recording forwarded message failed: {e}")
+        return Chat.get(user_id)
 
 def get_user_msg_id(user_id: int, topic_msg_id: int) -> Optional[int]:
     """Get user message ID from topic message ID"""
     try:
         conn = get_db()
         c = conn.cursor()
-        c.execute("SELECT user_msg_id FROM sent_messages WHERE user_id=? AND topic_msg_id=?",
-                  (user_id, topic_msg_id))
+        c.execute(SQL_MAPPING_GET, (user_id, topic_msg_id))
         row = c.fetchone()
-        conn.close()
         return row[0] if row else None
     except:
         return None
 
+# ============================================================
+# PER-CHAT DISPATCH (ordered within a chat, concurrent across chats)
+# ============================================================
+
+# (chat_id, topic_id) -> queue of (handler, update, ctx); each queue has one worker task
+CHAT_QUEUES: Dict[tuple, deque] = {}
+CHAT_WORKERS = set()
+
+def dispatch_key(update: Update) -> tuple:
+    """Private chats are keyed by chat, the support group by topic"""
+    msg = update.effective_message
+    thread_id = msg.message_thread_id if msg and msg.is_topic_message else None
+    return (update.effective_chat.id, thread_id)
+
+async def chat_worker(key: tuple, q: deque):
+    """Run queued updates of one chat in order, exit as soon as the queue is empty"""
+    while q:
+        handler, update, ctx = q.popleft()
+        try:
+            await handler(update, ctx)
+        except Exception as e:
+            await ctx.application.process_error(update, e)
+    # No await since the last check, so no update can be queued in between
+    del CHAT_QUEUES[key]
+
+def per_chat(handler):
+    """Wrap a handler so it only enqueues; the chat's worker runs it"""
+    async def wrapped(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        if not update.effective_chat:
+            return await handler(update, ctx)
+        key = dispatch_key(update)
+        q = CHAT_QUEUES.get(key)
+        if q is None:
+            q = CHAT_QUEUES[key] = deque()
+            # Application.stop() waits for tasks created through the application
+            task = ctx.application.create_task(chat_worker(key, q))
+            CHAT_WORKERS.add(task)
+            task.add_done_callback(CHAT_WORKERS.discard)
+        q.append((handler, update, ctx))
+    return wrapped
+
+async def finish_background_tasks(app: Application):
+    """post_stop: finish chat workers, topic updates and callback work while the bot can still send"""
+    # They can start each other, so repeat until nothing is left
+    while True:
+        pending = [t for t in (*CHAT_WORKERS, *TOPIC_UPDATE_TASKS, *CALLBACK_TASKS) if not t.done()]
+        if not pending:
+            return
+        await asyncio.gather(*pending, return_exceptions=True)
+
 # ============================================================
 # HANDLERS
 # ============================================================
@@ -678,6 +1261,14 @@ def get_user_msg_id(user_id: int, topic_msg_id: int) -> Optional[int]:
 # Track sequence recording
 PENDING_SEQUENCE = {}
 
+# Bot commands (COMMANDS plus /start), never forwarded to the user
+BOT_COMMANDS = frozenset({
+    'inbox', 'all', 'unread', 'read', 'info', 'vip', 'urgent', 'close',
+    'note', 't', 'q', 'save', 'del', 'qdel', 'undo', 'search', 'help',
+    'followup', 'done', 'skip', 'snooze', 'next', 'last',
+    'bc', 'broadcast', 'confirm', 'cancel', 'start'
+})
+
 async def handle_user(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Handle incoming user messages"""
     if not update.effective_chat or update.effective_chat.type != "private":
@@ -693,27 +1284,27 @@ async def handle_user(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await handle_sequence_record(update, ctx)
         return
     
+    # One clock read for every write this message causes
+    now_ts = int(time.time())
+    
     # Get or create chat
     chat = Chat.get(user.id)
     
     if not chat or chat['is_archived']:
-        topic_id = await create_topic(ctx.bot, user)
+        chat = await create_topic(ctx.bot, user, now_ts)
         if WELCOME_MESSAGE:
             await msg.reply_text(WELCOME_MESSAGE)
-        chat = Chat.get(user.id)
     
-    # Forward to topic
-    success = await forward_to_topic(ctx.bot, msg, chat['topic_id'], user.id)
+    # Forward to topic (returns the updated row, no re-select needed)
+    updated = await forward_to_topic(ctx.bot, msg, chat['topic_id'], user.id, now_ts)
     
-    if not success:
+    if not updated:
         # Topic might not exist, try to create new one
-        topic_id = await create_topic(ctx.bot, user)
-        chat = Chat.get(user.id)
-        await forward_to_topic(ctx.bot, msg, chat['topic_id'], user.id)
+        chat = await create_topic(ctx.bot, user, now_ts)
+        updated = await forward_to_topic(ctx.bot, msg, chat['topic_id'], user.id, now_ts)
     
     # Update topic status
-    chat = Chat.get(user.id)
-    await update_topic(ctx.bot, chat)
+    await update_topic(ctx.bot, updated or chat)
 
 async def handle_admin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Handle admin messages in support group"""
@@ -730,33 +1321,46 @@ async def handle_admin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not topic_id:
         return
     
-    # Check if it's a bot command
-    BOT_COMMANDS = [
-        'inbox', 'all', 'unread', 'read', 'info', 'vip', 'urgent', 'close',
-        'note', 't', 'q', 'save', 'del', 'qdel', 'undo', 'search', 'help',
-        'followup', 'done', 'skip', 'snooze', 'next', 'last',
-        'bc', 'broadcast', 'confirm', 'cancel', 'start'
-    ]
+    # Check if it's a bot command (only non-empty texts starting with '/' are split, once)
+    text = msg.text
+    if text and text[0] == '/' and len(text) > 1 and not text[1].isspace():
+        cmd = text[1:].split(maxsplit=1)[0].split('@', 1)[0].lower()
+        if cmd in BOT_COMMANDS:
+            return
     
-    if msg.text:
-        first_word = msg.text.split()[0].lower() if msg.text.split() else ""
-        if first_word.startswith('/'):
-            cmd = first_word[1:].split('@')[0]
-            if cmd in BOT_COMMANDS:
-                return
+    now_ts = int(time.time())
     
     # Get chat for this topic
     chat = Chat.get_by_topic(topic_id)
     if not chat:
         return
     
-    # Forward to user
-    sent_id = await forward_to_user(ctx.bot, msg, chat['user_id'], topic_id)
+    # Forward to user (returns the updated row, no re-select needed)
+    updated = await forward_to_user(ctx.bot, msg, chat['user_id'], topic_id, now_ts)
     
-    if sent_id:
-        # Update topic
-        chat = Chat.get(chat['user_id'])
-        await update_topic(ctx.bot, chat)
+    # Update topic
+    await update_topic(ctx.bot, updated)
+
+def is_command(msg: Optional[Message]) -> bool:
+    """Same test as filters.COMMAND: a bot_command entity at offset 0"""
+    return bool(msg and msg.entities and msg.entities[0].type == MessageEntityType.BOT_COMMAND
+                and msg.entities[0].offset == 0)
+
+async def route_message(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    """Single entry for non-callback messages: pick the handler from the chat once"""
+    if is_command(update.effective_message) and await route_command(update, ctx):
+        return
+    
+    chat = update.effective_chat
+    if chat.type == ChatType.PRIVATE:
+        # Unknown private commands are ignored
+        if not is_command(update.effective_message):
+            await handle_user(update, ctx)
+    elif chat.id == SUPPORT_GROUP_ID:
+        if update.message and update.message.forum_topic_edited:
+            await delete_service_messages(update, ctx)
+        else:
+            await handle_admin(update, ctx)
 
 async def handle_sequence_record(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Handle messages during sequence recording"""
@@ -784,7 +1388,7 @@ async def cmd_inbox(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != SUPPORT_GROUP_ID:
         return
     
-    unread = Chat.get_unread()
+    unread = Chat.get_unread_brief()
     
     if not unread:
         await update.message.reply_text("✅ Inbox leer!")
@@ -792,26 +1396,26 @@ async def cmd_inbox(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     lines = [f"📬 <b>{len(unread)} ungelesen</b>\n"]
     
-    for i, chat in enumerate(unread[:10], 1):
-        name = get_name(chat)
-        preview = chat.get('last_message_preview', '')[:30] or ''
-        time = time_ago(chat.get('last_message_at'))
-        p = PRIORITY.get(chat.get('priority', ''), '')
+    for i, (user_id, first, last, username, priority, _, preview, message_at, _, _) in enumerate(unread[:10], 1):
+        name = format_name(first, last, username, user_id)
+        preview = (preview or '')[:30]
+        time = time_ago(message_at)
+        p = PRIORITY.get(priority, '')
         
-        lines.append(f"{i}. {p}{html.escape(name)}")
-        lines.append(f"   <i>{html.escape(preview)}...</i> • {time}")
+        lines.append(f"{i}. {p}{name.translate(HTML_ESCAPE)}")
+        lines.append(f"   <i>{preview.translate(HTML_ESCAPE)}...</i> • {time}")
     
     if len(unread) > 10:
         lines.append(f"\n... +{len(unread) - 10} weitere")
     
     # Inline buttons for first 5
     buttons = []
-    for i, chat in enumerate(unread[:5], 1):
+    for i, (user_id, *_, topic_id) in enumerate(unread[:5], 1):
         buttons.append([
-            InlineKeyboardButton(f"#{i} öffnen", url=f"https://t.me/c/{str(SUPPORT_GROUP_ID)[4:]}/{chat['topic_id']}"),
-            InlineKeyboardButton("✓", callback_data=f"read:{chat['user_id']}"),
-            InlineKeyboardButton("⭐", callback_data=f"vip:{chat['user_id']}"),
-            InlineKeyboardButton("🚨", callback_data=f"urgent:{chat['user_id']}")
+            InlineKeyboardButton(f"#{i} öffnen", url=f"{GROUP_LINK_PREFIX}{topic_id}"),
+            InlineKeyboardButton("✓", callback_data=f"read:{user_id}"),
+            InlineKeyboardButton("⭐", callback_data=f"vip:{user_id}"),
+            InlineKeyboardButton("🚨", callback_data=f"urgent:{user_id}")
         ])
     
     buttons.append([
@@ -830,7 +1434,7 @@ async def cmd_followup(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != SUPPORT_GROUP_ID:
         return
     
-    followups = Chat.get_followups_due()
+    followups = Chat.get_followups_due_brief()
     total = len(followups['due']) + len(followups['urgent']) + len(followups['overdue'])
     
     if total == 0:
@@ -847,16 +1451,16 @@ async def cmd_followup(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         
         lines.append(f"\n<b>{emoji} {label} ({len(chats)})</b>")
         
-        for chat in chats[:3]:
-            name = get_name(chat)
-            time = time_ago(chat.get('last_reply_at'))
-            p = PRIORITY.get(chat.get('priority', ''), '')
-            lines.append(f"• {p}{html.escape(name)} – {time}")
+        for user_id, first, last, username, priority, _, _, _, reply_at, topic_id in chats[:3]:
+            name = format_name(first, last, username, user_id)
+            time = time_ago(reply_at)
+            p = PRIORITY.get(priority, '')
+            lines.append(f"• {p}{name.translate(HTML_ESCAPE)} – {time}")
             
             buttons.append([
-                InlineKeyboardButton(f"📝 {name[:15]}", url=f"https://t.me/c/{str(SUPPORT_GROUP_ID)[4:]}/{chat['topic_id']}"),
-                InlineKeyboardButton("✓ Done", callback_data=f"fudone:{chat['user_id']}"),
-                InlineKeyboardButton("⏭ Skip", callback_data=f"fuskip:{chat['user_id']}")
+                InlineKeyboardButton(f"📝 {name[:15]}", url=f"{GROUP_LINK_PREFIX}{topic_id}"),
+                InlineKeyboardButton("✓ Done", callback_data=f"fudone:{user_id}"),
+                InlineKeyboardButton("⏭ Skip", callback_data=f"fuskip:{user_id}")
             ])
     
     await update.message.reply_text(
@@ -870,7 +1474,7 @@ async def cmd_all(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.id != SUPPORT_GROUP_ID:
         return
     
-    chats = Chat.get_all_active()
+    chats = Chat.get_all_active_brief()
     
     if not chats:
         await update.message.reply_text("Keine aktiven Chats")
@@ -878,12 +1482,12 @@ async def cmd_all(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     lines = [f"📋 <b>{len(chats)} aktive Chats</b>\n"]
     
-    for chat in chats[:15]:
-        name = get_name(chat)
-        s = STATUS.get(chat.get('status', ''), '')
-        p = PRIORITY.get(chat.get('priority', ''), '')
-        time = time_ago(chat.get('last_message_at'))
-        lines.append(f"{p}{s} {html.escape(name)} • {time}")
+    for user_id, first, last, username, priority, status, _, message_at, _, _ in chats[:15]:
+        name = format_name(first, last, username, user_id)
+        s = STATUS.get(status, '')
+        p = PRIORITY.get(priority, '')
+        time = time_ago(message_at)
+        lines.append(f"{p}{s} {name.translate(HTML_ESCAPE)} • {time}")
     
     if len(chats) > 15:
         lines.append(f"\n... +{len(chats) - 15} weitere")
@@ -906,10 +1510,10 @@ async def cmd_next(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     chat = unread[0]
     name = get_name(chat)
-    link = f"https://t.me/c/{str(SUPPORT_GROUP_ID)[4:]}/{chat['topic_id']}"
+    link = f"{GROUP_LINK_PREFIX}{chat['topic_id']}"
     
     await update.message.reply_text(
-        f"➡️ <b>{html.escape(name)}</b>\n\n<a href='{link}'>Zum Chat</a>",
+        f"➡️ <b>{name.translate(HTML_ESCAPE)}</b>\n\n<a href='{link}'>Zum Chat</a>",
         parse_mode=ParseMode.HTML
     )
 
@@ -925,10 +1529,10 @@ async def cmd_last(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     chat = chats[0]
     name = get_name(chat)
-    link = f"https://t.me/c/{str(SUPPORT_GROUP_ID)[4:]}/{chat['topic_id']}"
+    link = f"{GROUP_LINK_PREFIX}{chat['topic_id']}"
     
     await update.message.reply_text(
-        f"🔙 <b>{html.escape(name)}</b>\n\n<a href='{link}'>Zum Chat</a>",
+        f"🔙 <b>{name.translate(HTML_ESCAPE)}</b>\n\n<a href='{link}'>Zum Chat</a>",
         parse_mode=ParseMode.HTML
     )
 
@@ -953,7 +1557,7 @@ async def cmd_snooze(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         except:
             pass
     
-    Chat.snooze(chat['user_id'], hours)
+    await Chat.snooze(chat['user_id'], hours)
     await update.message.reply_text(f"😴 Für {hours}h ausgeblendet")
 
 # ============================================================
@@ -969,16 +1573,14 @@ async def cmd_unread(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if topic_id:
         chat = Chat.get_by_topic(topic_id)
         if chat:
-            Chat.mark_unread(chat['user_id'])
-            await update_topic(ctx.bot, Chat.get(chat['user_id']))
+            await update_topic(ctx.bot, await Chat.mark_unread(chat['user_id']))
             await update.message.reply_text("🔴 Ungelesen")
             return
     
     if ctx.args:
         for c in Chat.get_all_active():
             if ctx.args[0].lower() in get_name(c).lower():
-                Chat.mark_unread(c['user_id'])
-                await update_topic(ctx.bot, Chat.get(c['user_id']))
+                await update_topic(ctx.bot, await Chat.mark_unread(c['user_id']))
                 await update.message.reply_text(f"🔴 {get_name(c)} – Ungelesen")
                 return
         await update.message.reply_text("Nicht gefunden")
@@ -992,8 +1594,7 @@ async def cmd_read(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if topic_id:
         chat = Chat.get_by_topic(topic_id)
         if chat:
-            Chat.mark_read(chat['user_id'])
-            await update_topic(ctx.bot, Chat.get(chat['user_id']))
+            await update_topic(ctx.bot, await Chat.mark_read(chat['user_id']))
             await update.message.reply_text("⚪ Gelesen")
 
 async def cmd_vip(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -1010,9 +1611,7 @@ async def cmd_vip(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     
     new_priority = "normal" if chat['priority'] == 'vip' else 'vip'
-    Chat.set_priority(chat['user_id'], new_priority)
-    chat = Chat.get(chat['user_id'])
-    await update_topic(ctx.bot, chat)
+    await update_topic(ctx.bot, await Chat.set_priority(chat['user_id'], new_priority))
     await update.message.reply_text("⭐ VIP" if new_priority == 'vip' else "VIP entfernt")
 
 async def cmd_urgent(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -1029,9 +1628,7 @@ async def cmd_urgent(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     
     new_priority = "normal" if chat['priority'] == 'urgent' else 'urgent'
-    Chat.set_priority(chat['user_id'], new_priority)
-    chat = Chat.get(chat['user_id'])
-    await update_topic(ctx.bot, chat)
+    await update_topic(ctx.bot, await Chat.set_priority(chat['user_id'], new_priority))
     await update.message.reply_text("🚨 Dringend" if new_priority == 'urgent' else "Dringend entfernt")
 
 async def cmd_close(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -1047,7 +1644,8 @@ async def cmd_close(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not chat:
         return
     
-    Chat.archive(chat['user_id'])
+    await Chat.archive(chat['user_id'])
+    TOPIC_USER_CACHE.pop(topic_id, None)
     
     try:
         await ctx.bot.close_forum_topic(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id)
@@ -1071,14 +1669,14 @@ async def cmd_info(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     name = get_name(chat)
     lines = [
-        f"👤 <b>{html.escape(name)}</b>",
+        f"👤 <b>{name.translate(HTML_ESCAPE)}</b>",
         f"",
         f"🆔 <code>{chat['user_id']}</code>",
         f"📊 Status: {STATUS.get(chat['status'], '')} {chat['status']}",
         f"⭐ Priorität: {chat['priority']}",
         f"📨 Ungelesen: {chat['unread_count']}",
         f"",
-        f"📅 Erstellt: {chat.get('created_at', '?')}",
+        f"📅 Erstellt: {format_ts(chat.get('created_at'))}",
         f"💬 Letzte Nachricht: {time_ago(chat.get('last_message_at'))}",
         f"↩️ Letzte Antwort: {time_ago(chat.get('last_reply_at'))}"
     ]
@@ -1086,14 +1684,13 @@ async def cmd_info(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     # Get notes
     conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT note, created_at FROM notes WHERE user_id=? ORDER BY created_at DESC LIMIT 3", (chat['user_id'],))
+    c.execute(SQL_NOTES_RECENT, (chat['user_id'],))
     notes = c.fetchall()
-    conn.close()
     
     if notes:
         lines.append("\n📝 <b>Notizen:</b>")
         for note, created in notes:
-            lines.append(f"• {html.escape(note)}")
+            lines.append(f"• {unpack_text(note).translate(HTML_ESCAPE)}")
     
     await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
 
@@ -1115,11 +1712,7 @@ async def cmd_note(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     
     note = " ".join(ctx.args)
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("INSERT INTO notes (user_id, note) VALUES (?, ?)", (chat['user_id'], note))
-    conn.commit()
-    conn.close()
+    await run_db(write_one, SQL_NOTE_ADD, (chat['user_id'], pack_text(note)))
     
     await update.message.reply_text(f"📝 Notiz gespeichert")
 
@@ -1127,6 +1720,23 @@ async def cmd_note(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 # COMMANDS - TEMPLATES
 # ============================================================
 
+# TEMPLATES is static at runtime, so the /t overview is built once
+TEMPLATES_OVERVIEW = "\n".join(
+    ["📝 <b>Templates</b>\n"] + [f"• <b>{name}</b>: {text[:40].translate(HTML_ESCAPE)}..." for name, text in TEMPLATES.items()]
+)
+TEMPLATES_SHOW_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(f"📝 {name}", callback_data=f"tmplshow:{name}")] for name in TEMPLATES]
+) if TEMPLATES else None
+
+@functools.lru_cache(maxsize=256)
+def templates_send_keyboard(user_id: int) -> Optional[InlineKeyboardMarkup]:
+    """Send buttons for one user (keyboards are immutable, safe to share)"""
+    if not TEMPLATES:
+        return None
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton(f"📤 {name}", callback_data=f"tmpl:{name}:{user_id}")] for name in TEMPLATES]
+    )
+
 async def cmd_t(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Send text template with buttons"""
     if update.effective_chat.id != SUPPORT_GROUP_ID:
@@ -1137,21 +1747,10 @@ async def cmd_t(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     if not ctx.args:
         # Show templates with buttons
-        buttons = []
-        for name in TEMPLATES:
-            if chat:
-                buttons.append([InlineKeyboardButton(f"📤 {name}", callback_data=f"tmpl:{name}:{chat['user_id']}")])
-            else:
-                buttons.append([InlineKeyboardButton(f"📝 {name}", callback_data=f"tmplshow:{name}")])
-        
-        lines = ["📝 <b>Templates</b>\n"]
-        for name, text in TEMPLATES.items():
-            lines.append(f"• <b>{name}</b>: {html.escape(text[:40])}...")
-        
         await update.message.reply_text(
-            "\n".join(lines),
+            TEMPLATES_OVERVIEW,
             parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup(buttons) if buttons else None
+            reply_markup=templates_send_keyboard(chat['user_id']) if chat else TEMPLATES_SHOW_KEYBOARD
         )
         return
     
@@ -1170,8 +1769,7 @@ async def cmd_t(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     try:
         await ctx.bot.send_message(chat_id=chat['user_id'], text=tmpl)
         log_msg(chat['user_id'], "out", "text", tmpl)
-        Chat.mark_answered(chat['user_id'])
-        await update_topic(ctx.bot, Chat.get(chat['user_id']))
+        await update_topic(ctx.bot, await Chat.mark_answered(chat['user_id']))
         await update.message.reply_text(f"📤 Gesendet")
     except Exception as e:
         await update.message.reply_text(f"⚠️ {e}")
@@ -1190,18 +1788,12 @@ async def cmd_save(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         # List sequences
         conn = get_db()
         c = conn.cursor()
-        c.execute("SELECT DISTINCT name FROM sequences ORDER BY name")
-        names = [row[0] for row in c.fetchall()]
-        conn.close()
+        c.execute(SQL_SEQUENCE_LIST)
+        sequences = c.fetchall()
         
-        if names:
+        if sequences:
             lines = ["📦 <b>Kurzbefehle</b>\n"]
-            for name in names:
-                conn = get_db()
-                c = conn.cursor()
-                c.execute("SELECT COUNT(*) FROM sequences WHERE name=?", (name,))
-                count = c.fetchone()[0]
-                conn.close()
+            for name, count in sequences:
                 lines.append(f"• /q {name} ({count} Nachrichten)")
             lines.append("\n/save name → neu erstellen")
             await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
@@ -1212,11 +1804,7 @@ async def cmd_save(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     name = ctx.args[0].lower()
     
     # Delete old
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("DELETE FROM sequences WHERE name=?", (name,))
-    conn.commit()
-    conn.close()
+    await run_db(write_one, SQL_SEQUENCE_DELETE, (name,))
     
     PENDING_SEQUENCE[user_id] = {'name': name, 'messages': []}
     await update.message.reply_text(f"📦 <b>Kurzbefehl '{name}'</b>\n\nSende jetzt Nachrichten...\n/done wenn fertig", parse_mode=ParseMode.HTML)
@@ -1236,15 +1824,8 @@ async def cmd_done(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             return
         
         # Save to DB
-        conn = get_db()
-        c = conn.cursor()
-        for i, msg_data in enumerate(messages):
-            c.execute("""
-                INSERT INTO sequences (name, position, original_chat_id, original_msg_id)
-                VALUES (?, ?, ?, ?)
-            """, (name, i, msg_data['chat_id'], msg_data['message_id']))
-        conn.commit()
-        conn.close()
+        rows = [(name, i, m['chat_id'], m['message_id']) for i, m in enumerate(messages)]
+        await run_db(write_many, SQL_SEQUENCE_ADD, rows)
         
         await update.message.reply_text(f"✅ <b>{name}</b> gespeichert ({len(messages)} Nachrichten)\n\n/q {name} zum Senden", parse_mode=ParseMode.HTML)
         return
@@ -1254,7 +1835,7 @@ async def cmd_done(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if topic_id:
         chat = Chat.get_by_topic(topic_id)
         if chat:
-            Chat.done_followup(chat['user_id'])
+            await Chat.done_followup(chat['user_id'])
             await update.message.reply_text("✅ Follow-up erledigt")
             return
     
@@ -1281,15 +1862,15 @@ async def cmd_q(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     name = ctx.args[0].lower()
     conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT original_chat_id, original_msg_id FROM sequences WHERE name=? ORDER BY position", (name,))
+    c.execute(SQL_SEQUENCE_GET, (name,))
     messages = c.fetchall()
-    conn.close()
     
     if not messages:
         await update.message.reply_text(f"❌ '{name}' nicht gefunden")
         return
     
     sent_count = 0
+    failed = []
     for orig_chat_id, orig_msg_id in messages:
         try:
             await ctx.bot.copy_message(
@@ -1301,12 +1882,19 @@ async def cmd_q(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
             await asyncio.sleep(0.3)
         except Exception as e:
             logging.warning(f"Failed to send sequence message: {e}")
+            failed.append(("to_user", orig_chat_id, chat['user_id'], orig_msg_id, topic_id))
+    
+    # Retry failed parts via outbox
+    if failed:
+        await run_db(Outbox.add_many, failed)
     
     if sent_count > 0:
-        Chat.mark_answered(chat['user_id'])
-        await update_topic(ctx.bot, Chat.get(chat['user_id']))
+        await update_topic(ctx.bot, await Chat.mark_answered(chat['user_id']))
     
-    await update.message.reply_text(f"✅ {sent_count}/{len(messages)} Nachrichten gesendet")
+    text = f"✅ {sent_count}/{len(messages)} Nachrichten gesendet"
+    if failed:
+        text += f"\n⏳ {len(failed)} in der Warteschlange"
+    await update.message.reply_text(text)
 
 async def cmd_qdel(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Delete sequence"""
@@ -1319,12 +1907,7 @@ async def cmd_qdel(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     
     name = ctx.args[0].lower()
-    conn = get_db()
-    c = conn.cursor()
-    c.execute("DELETE FROM sequences WHERE name=?", (name,))
-    deleted = c.rowcount
-    conn.commit()
-    conn.close()
+    deleted = await run_db(write_one, SQL_SEQUENCE_DELETE, (name,))
     
     if deleted:
         await update.message.reply_text(f"🗑 <b>{name}</b> gelöscht", parse_mode=ParseMode.HTML)
@@ -1387,31 +1970,31 @@ async def cmd_undo(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if ctx.args:
         try:
             count = int(ctx.args[0])
-        except:
-            pass
+        except ValueError:
+            count = 0
+        if count < 1:
+            await update.message.reply_text("/undo [anzahl]")
+            return
+    count = min(count, MAPPING_SLOTS)
     
     # Get last messages from DB
     conn = get_db()
     c = conn.cursor()
-    c.execute("""
-        SELECT user_msg_id FROM sent_messages 
-        WHERE user_id=? 
-        ORDER BY id DESC LIMIT ?
-    """, (chat['user_id'], count))
+    c.execute(SQL_MAPPING_LAST, (chat['user_id'], count))
     messages = c.fetchall()
-    conn.close()
     
     if not messages:
         await update.message.reply_text("❌ Keine Nachrichten zum Löschen")
         return
     
-    deleted = 0
-    for (msg_id,) in messages:
-        try:
+    sem = asyncio.Semaphore(UNDO_CONCURRENCY)
+    
+    async def delete(msg_id: int):
+        async with sem:
             await ctx.bot.delete_message(chat_id=chat['user_id'], message_id=msg_id)
-            deleted += 1
-        except:
-            pass
+    
+    results = await asyncio.gather(*(delete(msg_id) for (msg_id,) in messages), return_exceptions=True)
+    deleted = sum(1 for r in results if not isinstance(r, Exception))
     
     await update.message.reply_text(f"🗑 {deleted} gelöscht")
 
@@ -1447,7 +2030,7 @@ async def cmd_broadcast(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     elif target == "all":
         recipients = Chat.get_all_active()
     elif target == "vip":
-        recipients = [c for c in Chat.get_all_active() if c['priority'] == 'vip']
+        recipients = Chat.get_by_priority('vip')
     else:
         await update.message.reply_text("Nutze: followup, all, vip")
         return
@@ -1466,7 +2049,7 @@ async def cmd_broadcast(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         f"📢 <b>Broadcast an {len(recipients)} Empfänger</b>\n\n"
         f"{', '.join(names)}{'...' if len(recipients) > 5 else ''}\n\n"
-        f"<i>{html.escape(message[:100])}</i>\n\n"
+        f"<i>{message[:100].translate(HTML_ESCAPE)}</i>\n\n"
         f"/confirm zum Senden",
         parse_mode=ParseMode.HTML
     )
@@ -1483,17 +2066,30 @@ async def cmd_confirm(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     recipients = bc['recipients']
     message = bc['message']
     
-    sent = 0
-    for r in recipients:
-        try:
-            await ctx.bot.send_message(chat_id=r['user_id'], text=message)
-            Chat.mark_answered(r['user_id'])
-            sent += 1
-            await asyncio.sleep(0.1)
-        except:
-            pass
+    # Each send holds its slot for a full second, so at most BROADCAST_PER_SECOND start per second
+    sem = asyncio.Semaphore(BROADCAST_PER_SECOND)
     
-    await update.message.reply_text(f"✅ {sent}/{len(recipients)} gesendet")
+    async def send(r: Dict) -> Optional[int]:
+        """Send to one recipient, return the user_id once delivered"""
+        async with sem:
+            try:
+                await ctx.bot.send_message(chat_id=r['user_id'], text=message)
+            except Exception:
+                return None
+            finally:
+                await asyncio.sleep(1)
+            return r['user_id']
+    
+    results = await asyncio.gather(*(send(r) for r in recipients))
+    delivered = [uid for uid in results if uid is not None]
+    
+    # Mark all delivered chats answered in one transaction
+    if delivered:
+        now = int(time.time())
+        await run_db(write_many, SQL_CHAT_MARK_ANSWERED, [(now, uid) for uid in delivered])
+        invalidate_chat()
+    
+    await update.message.reply_text(f"✅ {len(delivered)}/{len(recipients)} gesendet")
 
 async def cmd_cancel(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Cancel broadcast"""
@@ -1518,24 +2114,21 @@ async def cmd_search(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     conn = get_db()
     c = conn.cursor()
-    c.execute("""
-        SELECT m.content, m.direction, c.first_name, c.topic_id
-        FROM messages m 
-        JOIN chats c ON m.user_id=c.user_id 
-        WHERE m.content LIKE ? 
-        ORDER BY m.created_at DESC LIMIT 10
-    """, (f"%{q}%",))
+    # Trigrams need 3+ characters; the query is quoted as one FTS phrase
+    if FTS_ENABLED and len(q) >= 3:
+        c.execute(SQL_SEARCH_FTS, ('"' + q.replace('"', '""') + '"',))
+    else:
+        c.execute(SQL_SEARCH_LIKE, (f"%{q}%",))
     results = c.fetchall()
-    conn.close()
     
     if not results:
         await update.message.reply_text("Nichts gefunden")
         return
     
-    lines = [f"🔍 <b>'{html.escape(q)}'</b>\n"]
+    lines = [f"🔍 <b>'{q.translate(HTML_ESCAPE)}'</b>\n"]
     for content, direction, name, topic_id in results:
         arrow = "↗️" if direction == "out" else "↙️"
-        lines.append(f"{arrow} <b>{html.escape(name or '?')}</b>: {html.escape(content[:40])}")
+        lines.append(f"{arrow} <b>{(name or '?').translate(HTML_ESCAPE)}</b>: {content[:40].translate(HTML_ESCAPE)}")
     
     await update.message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
 
@@ -1560,7 +2153,7 @@ async def cmd_skip(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         except:
             pass
     
-    Chat.snooze(chat['user_id'], days * 24)
+    await Chat.snooze(chat['user_id'], days * 24)
     await update.message.reply_text(f"⏭ Für {days} Tage übersprungen")
 
 async def cmd_help(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -1600,6 +2193,17 @@ async def cmd_help(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 # CALLBACK HANDLERS
 # ============================================================
 
+# Strong references to fire-and-forget callback work
+CALLBACK_TASKS = set()
+
+async def mark_all_read_bg(query):
+    """Mark every unread chat read, then confirm"""
+    try:
+        await Chat.mark_all_read()
+        await query.edit_message_text("✅ Alle als gelesen markiert")
+    except Exception as e:
+        logging.error(f"Mark all read failed: {e}")
+
 async def handle_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Handle inline button callbacks"""
     query = update.callback_query
@@ -1618,37 +2222,37 @@ async def handle_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(f"📬 {len(unread)} ungelesen - /inbox für Details")
     
     elif data == "inbox:readall":
-        for chat in Chat.get_unread():
-            Chat.mark_read(chat['user_id'])
-        await query.edit_message_text("✅ Alle als gelesen markiert")
+        task = asyncio.create_task(mark_all_read_bg(query))
+        CALLBACK_TASKS.add(task)
+        task.add_done_callback(CALLBACK_TASKS.discard)
     
     elif data.startswith("read:"):
         user_id = int(data.split(":")[1])
-        Chat.mark_read(user_id)
+        await Chat.mark_read(user_id)
         await query.answer("✓ Gelesen")
     
     elif data.startswith("vip:"):
         user_id = int(data.split(":")[1])
         chat = Chat.get(user_id)
         new_p = "normal" if chat and chat['priority'] == 'vip' else 'vip'
-        Chat.set_priority(user_id, new_p)
+        await Chat.set_priority(user_id, new_p)
         await query.answer("⭐ VIP" if new_p == 'vip' else "VIP entfernt")
     
     elif data.startswith("urgent:"):
         user_id = int(data.split(":")[1])
         chat = Chat.get(user_id)
         new_p = "normal" if chat and chat['priority'] == 'urgent' else 'urgent'
-        Chat.set_priority(user_id, new_p)
+        await Chat.set_priority(user_id, new_p)
         await query.answer("🚨 Dringend" if new_p == 'urgent' else "Entfernt")
     
     elif data.startswith("fudone:"):
         user_id = int(data.split(":")[1])
-        Chat.done_followup(user_id)
+        await Chat.done_followup(user_id)
         await query.answer("✅ Erledigt")
     
     elif data.startswith("fuskip:"):
         user_id = int(data.split(":")[1])
-        Chat.snooze(user_id, 72)
+        await Chat.snooze(user_id, 72)
         await query.answer("⏭ Übersprungen")
     
     elif data.startswith("tmpl:"):
@@ -1659,46 +2263,109 @@ async def handle_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         if tmpl:
             try:
                 await ctx.bot.send_message(chat_id=user_id, text=tmpl)
-                Chat.mark_answered(user_id)
+                await Chat.mark_answered(user_id)
                 await query.answer("📤 Gesendet")
             except Exception as e:
                 await query.answer(f"Fehler: {e}")
 
+# ============================================================
+# COMMAND ROUTER
+# ============================================================
+
+# One dict lookup per command instead of a CommandHandler filter chain per command
+COMMANDS = {
+    "inbox": cmd_inbox, "all": cmd_all, "next": cmd_next, "last": cmd_last,
+    "unread": cmd_unread, "read": cmd_read, "vip": cmd_vip, "urgent": cmd_urgent,
+    "close": cmd_close, "info": cmd_info, "note": cmd_note, "snooze": cmd_snooze,
+    "t": cmd_t, "q": cmd_q, "save": cmd_save, "done": cmd_done,
+    "del": cmd_del, "qdel": cmd_qdel, "undo": cmd_undo,
+    "search": cmd_search, "help": cmd_help,
+    "followup": cmd_followup, "skip": cmd_skip,
+    "bc": cmd_broadcast, "broadcast": cmd_broadcast,
+    "confirm": cmd_confirm, "cancel": cmd_cancel
+}
+
+async def route_command(update: Update, ctx: ContextTypes.DEFAULT_TYPE) -> bool:
+    """Run the command handler for a /command message, False if it is not one of ours
+
+    Parses like CommandHandler: /cmd@other_bot is ignored, ctx.args are the words after it.
+    """
+    msg = update.effective_message
+    name, _, target = msg.text[1:msg.entities[0].length].partition('@')
+    fn = COMMANDS.get(name.lower())
+    if not fn or (target and target.lower() != ctx.bot.username.lower()):
+        return False
+    ctx.args = msg.text.split()[1:]
+    await fn(update, ctx)
+    return True
+
 # ============================================================
 # JOBS
 # ============================================================
 
-async def job_process_outbox(ctx: ContextTypes.DEFAULT_TYPE):
-    """Process pending outbox messages"""
-    pending = Outbox.get_pending()
-    
-    for item in pending:
+async def retry_outbox_item(bot: Bot, item: Dict, sem: asyncio.Semaphore) -> tuple:
+    """Re-send one outbox message, return (item, error or None)
+
+    The slot is held for a full second, so at most OUTBOX_PER_SECOND retries start per second.
+    """
+    async with sem:
         try:
             if item['direction'] == 'to_topic':
-                await ctx.bot.copy_message(
+                await bot.copy_message(
                     chat_id=item['to_chat_id'],
                     from_chat_id=item['from_chat_id'],
                     message_id=item['message_id'],
                     message_thread_id=item['topic_id']
                 )
             elif item['direction'] == 'to_user':
-                await ctx.bot.copy_message(
+                await bot.copy_message(
                     chat_id=item['to_chat_id'],
                     from_chat_id=item['from_chat_id'],
                     message_id=item['message_id']
                 )
             
-            Outbox.mark_sent(item['id'])
             logging.info(f"Outbox message {item['id']} sent successfully")
+            return item, None
             
         except Exception as e:
-            Outbox.mark_failed(item['id'], str(e))
             logging.warning(f"Outbox message {item['id']} failed: {e}")
+            return item, str(e)
+        
+        finally:
+            await asyncio.sleep(1)
+
+async def drain_outbox(bot: Bot):
+    """Retry pending outbox messages concurrently, then store all outcomes at once"""
+    pending = await run_db(Outbox.get_pending)
+    if not pending:
+        return
+    
+    sem = asyncio.Semaphore(OUTBOX_PER_SECOND)
+    results = await asyncio.gather(*[retry_outbox_item(bot, item, sem) for item in pending], return_exceptions=True)
+    # An unexpected error in one retry must not drop the outcomes of the messages already sent
+    await run_db(Outbox.apply_results, [r for r in results if not isinstance(r, BaseException)])
+
+async def job_process_outbox(ctx: ContextTypes.DEFAULT_TYPE):
+    """Process pending outbox messages"""
+    await drain_outbox(ctx.bot)
+
+async def job_flush_topic_cache(ctx: ContextTypes.DEFAULT_TYPE):
+    """Persist changed topic names"""
+    await run_db(write_topic_cache, take_dirty_topics())
+
+def optimize_db():
+    """Let SQLite refresh planner statistics"""
+    try:
+        get_db().execute("PRAGMA optimize")
+    except Exception as e:
+        logging.warning(f"PRAGMA optimize failed: {e}")
+
+async def job_optimize_db(ctx: ContextTypes.DEFAULT_TYPE):
+    await run_db(optimize_db)
 
 async def job_followup_morning(ctx: ContextTypes.DEFAULT_TYPE):
     """Morning follow-up report"""
-    followups = Chat.get_followups_due()
-    total = len(followups['due']) + len(followups['urgent']) + len(followups['overdue'])
+    total, followups = await run_db(Chat.get_followups_top, 3)
     
     if total == 0:
         return
@@ -1711,10 +2378,10 @@ async def job_followup_morning(ctx: ContextTypes.DEFAULT_TYPE):
     ]
     
     for stage, emoji in [('overdue', '🔴'), ('urgent', '🟠'), ('due', '💛')]:
-        for chat in followups[stage][:3]:
-            name = get_name(chat)
-            p = PRIORITY.get(chat.get('priority', ''), '')
-            lines.append(f"{emoji} {p}{html.escape(name)}")
+        for user_id, first, last, username, priority in followups[stage]:
+            name = format_name(first, last, username, user_id)
+            p = PRIORITY.get(priority, '')
+            lines.append(f"{emoji} {p}{name.translate(HTML_ESCAPE)}")
     
     lines.append("\n/followup für Details")
     
@@ -1726,20 +2393,49 @@ async def job_followup_morning(ctx: ContextTypes.DEFAULT_TYPE):
 
 async def job_archive(ctx: ContextTypes.DEFAULT_TYPE):
     """Auto-archive old chats"""
-    conn = get_db()
-    c = conn.cursor()
-    cutoff = datetime.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
-    c.execute("SELECT user_id, topic_id FROM chats WHERE is_archived=0 AND last_message_at<?", (cutoff,))
+    cutoff = int(time.time()) - ARCHIVE_AFTER_DAYS * 86400
+    archived = await run_db(write_rows, SQL_CHAT_ARCHIVE_STALE, (cutoff,))
     
-    for user_id, topic_id in c.fetchall():
-        try:
-            await ctx.bot.close_forum_topic(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id)
-        except:
-            pass
-        c.execute("UPDATE chats SET is_archived=1, status='closed' WHERE user_id=?", (user_id,))
+    for user_id, topic_id in archived:
+        invalidate_chat(user_id)
+        TOPIC_USER_CACHE.pop(topic_id, None)
     
-    conn.commit()
-    conn.close()
+    sem = asyncio.Semaphore(ARCHIVE_CONCURRENCY)
+    
+    async def close(topic_id: int):
+        async with sem:
+            try:
+                await ctx.bot.close_forum_topic(chat_id=SUPPORT_GROUP_ID, message_thread_id=topic_id)
+            except:
+                pass
+    
+    await asyncio.gather(*(close(topic_id) for _, topic_id in archived))
+    
+    # Archiving shifts the is_archived split the listing indexes rely on
+    if archived:
+        await run_db(optimize_db)
+
+# Short periodic jobs run from one scheduler tick: (job, interval, delay before first run).
+# job_archive keeps its own schedule, its topic closes would hold up the tick.
+TICK_JOBS = [
+    (job_process_outbox, OUTBOX_INTERVAL_SECONDS, 0),
+    (job_flush_topic_cache, TOPIC_CACHE_FLUSH_SECONDS, TOPIC_CACHE_FLUSH_SECONDS),
+    (job_optimize_db, OPTIMIZE_INTERVAL_SECONDS, OPTIMIZE_INTERVAL_SECONDS),
+]
+TICK_NEXT_RUN = {}  # job -> monotonic time it is due
+
+async def job_tick(ctx: ContextTypes.DEFAULT_TYPE):
+    """Run every periodic job that is due"""
+    now = time.monotonic()
+    for job, interval, first in TICK_JOBS:
+        due = TICK_NEXT_RUN.setdefault(job, now + first)
+        if now < due:
+            continue
+        TICK_NEXT_RUN[job] = now + interval
+        try:
+            await job(ctx)
+        except Exception as e:
+            logging.error(f"{job.__name__} failed: {e}")
 
 # ============================================================
 # ERROR HANDLER
@@ -1747,26 +2443,36 @@ async def job_archive(ctx: ContextTypes.DEFAULT_TYPE):
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     """Handle errors gracefully"""
-    logging.error(f"Exception: {context.error}")
-    
     if isinstance(context.error, (NetworkError, TimedOut)):
+        logging.error("Exception: %s", context.error)
         logging.info("Network error - will retry")
         return
     
-    tb = "".join(traceback.format_exception(type(context.error), context.error, context.error.__traceback__))
-    logging.error(f"Traceback:\n{tb}")
+    # exc_info leaves traceback formatting to the handler, only if the record is emitted
+    logging.error("Exception: %s", context.error, exc_info=context.error)
 
 # ============================================================
 # MAIN
 # ============================================================
 
-def main():
+# Built once at import: only private chats and the support group reach the router,
+# updates from other groups are dropped before a chat worker is started for them
+ROUTED_CHATS = filters.ChatType.PRIVATE | filters.Chat(SUPPORT_GROUP_ID)
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Log calls only enqueue; the returned listener thread does the stdout writes"""
+    log_queue = queue.SimpleQueue()
+    # QueueHandler formats at enqueue time, the stream handler writes the finished line
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    listener.start()
     logging.basicConfig(
         format='%(asctime)s - %(levelname)s - %(message)s',
-        level=logging.INFO,
-        handlers=[logging.StreamHandler(sys.stdout)]
+        level=LOG_LEVEL,
+        handlers=[logging.handlers.QueueHandler(log_queue)]
     )
-    
+    return listener
+
+def main():
     logging.info(f"Starting bot...")
     logging.info(f"Database: {DB_PATH}")
     logging.info(f"Support Group: {SUPPORT_GROUP_ID}")
@@ -1774,50 +2480,43 @@ def main():
     
     init_db()
     load_topic_cache()
+    start_db_writer()
     
-    app = Application.builder().token(BOT_TOKEN).build()
-    app.add_error_handler(error_handler)
+    # uvloop (optional, Linux only): faster event loop, must be installed before PTB creates it
+    try:
+        import uvloop
+        uvloop.install()
+        logging.info("Event loop: uvloop")
+    except ImportError:
+        pass
     
-    # Service message handler
-    app.add_handler(MessageHandler(
-        filters.Chat(SUPPORT_GROUP_ID) & filters.StatusUpdate.FORUM_TOPIC_EDITED,
-        delete_service_messages
-    ), group=0)
+    # Updates are processed concurrently; per_chat() enqueues without awaiting, so the
+    # order within a chat/topic is still the order PTB fetched them in
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .http_version(API_HTTP_VERSION)
+        .connection_pool_size(API_POOL_SIZE)
+        .concurrent_updates(True)
+        .post_stop(finish_background_tasks)
+        .build()
+    )
+    app.add_error_handler(error_handler)
     
-    # User messages
-    app.add_handler(MessageHandler(
-        filters.ChatType.PRIVATE & ~filters.COMMAND,
-        handle_user
-    ))
+    # Every handler goes through per_chat(): updates of one chat/topic stay in order,
+    # a slow chat no longer holds up the others
     
-    # Admin messages
-    app.add_handler(MessageHandler(
-        filters.Chat(SUPPORT_GROUP_ID),
-        handle_admin
-    ), group=1)
+    # Commands, user, admin and service messages: one router (commands via COMMANDS)
+    app.add_handler(MessageHandler(ROUTED_CHATS, per_chat(route_message)))
     
     # Callback handler
-    app.add_handler(CallbackQueryHandler(handle_callback))
-    
-    # Commands
-    commands = [
-        ("inbox", cmd_inbox), ("all", cmd_all), ("next", cmd_next), ("last", cmd_last),
-        ("unread", cmd_unread), ("read", cmd_read), ("vip", cmd_vip), ("urgent", cmd_urgent),
-        ("close", cmd_close), ("info", cmd_info), ("note", cmd_note), ("snooze", cmd_snooze),
-        ("t", cmd_t), ("q", cmd_q), ("save", cmd_save), ("done", cmd_done),
-        ("del", cmd_del), ("qdel", cmd_qdel), ("undo", cmd_undo),
-        ("search", cmd_search), ("help", cmd_help),
-        ("followup", cmd_followup), ("skip", cmd_skip),
-        ("bc", cmd_broadcast), ("broadcast", cmd_broadcast),
-        ("confirm", cmd_confirm), ("cancel", cmd_cancel)
-    ]
-    
-    for cmd, fn in commands:
-        app.add_handler(CommandHandler(cmd, fn))
+    app.add_handler(CallbackQueryHandler(per_chat(handle_callback)))
     
     # Jobs
-    app.job_queue.run_repeating(job_process_outbox, interval=OUTBOX_INTERVAL_SECONDS, first=10)
-    app.job_queue.run_repeating(job_archive, interval=3600, first=60)
+    # One tick drives the short periodic jobs (intervals are multiples of the tick),
+    # the archive run gets its own job so it never delays outbox retries
+    app.job_queue.run_repeating(job_tick, interval=OUTBOX_INTERVAL_SECONDS, first=10)
+    app.job_queue.run_repeating(job_archive, interval=ARCHIVE_INTERVAL_SECONDS, first=60)
     
     from datetime import time as dt_time
     app.job_queue.run_daily(job_followup_morning, time=dt_time(hour=FOLLOWUP_MORNING_HOUR, minute=0))
@@ -1825,22 +2524,46 @@ def main():
     print("🚀 Support Bot v2.0 gestartet")
     print(f"📁 Datenbank: {DB_PATH}")
     
-    app.run_polling(
-        allowed_updates=Update.ALL_TYPES,
-        drop_pending_updates=False
-    )
+    # run_* stop cleanly on SIGINT/SIGTERM (PTB's default stop_signals); queued writes are
+    # flushed afterwards, also when the run loop dies with an exception
+    try:
+        if WEBHOOK_URL:
+            app.run_webhook(
+                listen="0.0.0.0",
+                port=PORT,
+                url_path=BOT_TOKEN,
+                webhook_url=f"{WEBHOOK_URL}/{BOT_TOKEN}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=False
+            )
+        else:
+            # Each getUpdates blocks server-side until an update arrives or the timeout ends
+            app.run_polling(
+                allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates=False,
+                poll_interval=0.0,
+                timeout=POLL_TIMEOUT_SECONDS
+            )
+    finally:
+        flush_topic_cache()
+        stop_db_writer()
+        close_db()
 
+# Restarts are left to the supervisor (Railway restartPolicy), which starts a fresh
+# process instead of re-running main() next to a possibly still-open poll connection
 if __name__ == "__main__":
-    while True:
-        try:
-            main()
-        except KeyboardInterrupt:
-            print("\n👋 Bot gestoppt")
-            break
-        except Exception as e:
-            logging.error(f"Bot crashed: {e}")
-            logging.info("Neustart in 5 Sekunden...")
-            import time
-            time.sleep(5)
+    log_listener = setup_logging()
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n👋 Bot gestoppt")
+        sys.exit(0)
+    except Exception:
+        logging.exception("Bot crashed")
+        sys.exit(1)
+    finally:
+        # Writes out everything still queued before the process exits
+        log_listener.stop()
 
 